@@ -0,0 +1,303 @@
+''' omband, midi and audio looper
+Copyright (C) 2021,2022  Marcos Redwood (marcos.rc91 at gmail.com)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+'''
+
+# This script measures the timing of omband without a synthesizer or an audio interface. The midi ports are replaced by FakeMidiPort and PyAudio by a
+# virtual audio device that calls the stream callbacks in real time from a thread. It plays every combination of the values given on the command line and
+# prints the results as JSON, e.g.: python bench.py --tracks 1 8 --bpm 120 240 --seconds 2 > results.json. With --ports, the midi tracks are spread over
+# that many output ports ([Outputs] and [Routing]), each one with its own sender
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import threading
+import time
+import types
+
+import numpy
+
+
+# This class is a stream of the virtual audio device. Like a PyAudio stream with a callback, it asks for frames_per_buffer frames every buffer period
+class VirtualStream:
+    def __init__(self, rate, channels, frames_per_buffer=1024, stream_callback=None, input=False, output=False, **kwargs):
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.stream_callback = stream_callback
+        self.is_input = input
+        self.silence = bytes(frames_per_buffer * channels * 2)
+
+        self.callback_time = None
+        self.late_buffers = 0 # Buffers whose callback finished after the next one was due (an xrun in a real device)
+        self.thread = None
+        self.is_running = False
+
+    def start_stream(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="bench-audio", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        period_ns = self.frames_per_buffer * 1000000000 // self.rate
+        deadline = time.perf_counter_ns()
+        while self.is_running:
+            deadline += period_ns
+            remaining = deadline - time.perf_counter_ns()
+            if remaining > 0:
+                time.sleep(remaining / 1000000000)
+            start = time.perf_counter_ns()
+            in_data = self.silence if self.is_input else None
+            if self.stream_callback is not None:
+                self.stream_callback(in_data, self.frames_per_buffer, None, 0)
+            end = time.perf_counter_ns()
+            if self.callback_time is not None:
+                self.callback_time.add(end - start)
+            if end > deadline + period_ns:
+                self.late_buffers += 1
+
+    def stop_stream(self):
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop_stream()
+
+    def is_active(self):
+        return self.is_running
+
+    # The virtual device plays a buffer as soon as it has it
+    def get_output_latency(self):
+        return 0.0
+
+
+class VirtualPyAudio:
+    streams = []
+
+    def get_sample_size(self, format):
+        return 2
+
+    def open(self, **kwargs):
+        stream = VirtualStream(**kwargs)
+        VirtualPyAudio.streams.append(stream)
+        return stream
+
+    def terminate(self):
+        pass
+
+
+# cls imports pyaudio, so the virtual device has to be in place before
+sys.modules["pyaudio"] = types.ModuleType("pyaudio")
+sys.modules["pyaudio"].PyAudio = VirtualPyAudio
+sys.modules["pyaudio"].paInt16 = 8
+sys.modules["pyaudio"].paContinue = 0
+
+import mido
+import cls
+
+
+# This class replaces the mido ports. It only counts the messages sent
+class FakeMidiPort:
+    def __init__(self, name=None, callback=None, **kwargs):
+        self.name = name
+        self.callback = callback
+        self.sent = 0
+
+    def send(self, msg):
+        self.sent += 1
+
+    def reset(self):
+        pass
+
+    def panic(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def install_fake_ports():
+    mido.open_output = FakeMidiPort
+    mido.open_input = FakeMidiPort
+    mido.get_output_names = lambda: list(cls.get_config().outputs.values())
+    mido.get_input_names = lambda: ["bench"]
+
+
+# This one makes a loop of bars bars with density notes per beat (a note_on and a note_off each)
+def make_midi_track(density, bars, ticks_per_beat, note, name):
+    events = cls.MidiEventStore()
+    step = ticks_per_beat / density
+    for beat in range(bars * 4):
+        for index in range(density):
+            tick = 1 + beat * ticks_per_beat + index * step
+            events.append(mido.Message("note_on", note=note, velocity=100), tick)
+            events.append(mido.Message("note_off", note=note), tick + step / 2)
+    events.append(mido.MetaMessage("end_of_track"), bars * 4 * ticks_per_beat)
+    return cls.TrackMidi(events=events, ticks_per_beat=ticks_per_beat, name=name)
+
+
+def make_audio_track(index, bars, ticks_per_beat, bpm, rate):
+    seconds = bars * 4 * 60 / bpm
+    samples = (numpy.sin(numpy.arange(int(seconds * rate)) * 2 * numpy.pi * (110 + index) / rate) * 4000).astype(numpy.int16)
+    track = cls.TrackAudio(index, samples=samples)
+    track.final_tick = bars * 4 * ticks_per_beat
+    return track
+
+
+def get_events_bytes(tracks):
+    total = 0
+    for track in tracks:
+        events = track.events
+        for column in (events.ticks, events.statuses, events.data1, events.data2):
+            total += column.buffer_info()[1] * column.itemsize
+    return total
+
+
+# The memory the process uses now (its resident set, from /proc, so None where there isn't one). The peak (ru_maxrss) would be the one of the largest case
+# so far
+def get_rss_kb():
+    try:
+        with open("/proc/self/statm") as statm_file:
+            resident_pages = int(statm_file.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf("SC_PAGE_SIZE") // 1024
+
+
+def get_histogram_results(name, histogram):
+    return {name + "_p50_us": histogram.percentile(50), name + "_p99_us": histogram.percentile(99), name + "_max_us": histogram.max_us}
+
+
+# This one plays tracks midi tracks (on ports output ports) and tracks audio loops for seconds seconds and returns what was measured
+def run_case(tracks, density, ticks_per_beat, bpm, ports, seconds, bars):
+    config = cls.get_config()
+    config.set_override("Midi", "bpm", bpm)
+    config.set_override("Midi", "ticks_per_beat", ticks_per_beat)
+    config.clear_overrides("Outputs")
+    config.clear_overrides("Routing")
+    for port in range(1, ports):
+        config.set_override("Outputs", "port" + str(port), "bench" + str(port))
+    for index in range(tracks):
+        if index % ports > 0:
+            config.set_override("Routing", "bench" + str(index + 1), "port" + str(index % ports))
+
+    VirtualPyAudio.streams = []
+    track_registry = cls.TrackRegistry()
+    midi_manager = cls.MidiManager(track_registry)
+    audio_recorder = cls.AudioRecorder(track_registry)
+    transport = cls.Transport(midi_manager, audio_recorder)
+
+    midi_tracks = [make_midi_track(density, bars, ticks_per_beat, 36 + index % 60, "Bench" + str(index + 1)) for index in range(tracks)]
+    for track in midi_tracks:
+        midi_manager.tracks.append(track)
+        track_registry.add(track)
+    for index in range(tracks):
+        track = make_audio_track(index + 1, bars, ticks_per_beat, bpm, audio_recorder.rate)
+        audio_recorder.tracks.append(track)
+        track_registry.add(track)
+
+    # Every tick goes through the same consumers as in the application, timed as one
+    consumers = [midi_manager.process_tick, audio_recorder.update]
+    tick_cost = cls.LatencyHistogram(bin_width_us=5, bins=2000)
+    def timed_tick(clock):
+        start = time.perf_counter_ns()
+        for consumer in consumers:
+            consumer(clock)
+        tick_cost.add(time.perf_counter_ns() - start)
+    midi_manager.clock_engine.consumers = [timed_tick]
+
+    callback_time = cls.LatencyHistogram(bin_width_us=5, bins=2000)
+    for stream in VirtualPyAudio.streams:
+        stream.callback_time = callback_time
+
+    senders = midi_manager.scheduler.get_senders()
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    transport.start()
+    time.sleep(seconds)
+    ticks = midi_manager.clock.absolute_tick
+    rss_kb = get_rss_kb() # While the case is playing
+    transport.stop()
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+
+    result = {"tracks": tracks, "density": density, "ticks_per_beat": ticks_per_beat, "bpm": bpm, "ports": ports, "seconds": round(wall, 3),
+              "ticks": ticks, "expected_ticks": int(seconds * bpm * ticks_per_beat / 60),
+              "messages_per_second": round(sum(sender.output_device.port.sent for sender in senders) / wall, 1), "cpu_percent": round(cpu * 100 / wall, 1),
+              "audio_late_buffers": sum(stream.late_buffers for stream in VirtualPyAudio.streams),
+              "events_bytes": get_events_bytes(midi_tracks), "rss_kb": rss_kb}
+    result.update(get_histogram_results("lateness", midi_manager.clock_engine.lateness))
+    result.update(get_histogram_results("send_lateness", midi_manager.scheduler.get_lateness()))
+    result.update(get_histogram_results("tick_cost", tick_cost))
+    result.update(get_histogram_results("audio_callback", callback_time))
+    result["senders"] = []
+    for sender in senders:
+        sender_result = {"name": sender.name, "messages_per_second": round(sender.output_device.port.sent / wall, 1), "max_backlog": sender.max_backlog}
+        sender_result.update(get_histogram_results("send_lateness", sender.lateness))
+        result["senders"].append(sender_result)
+
+    midi_manager.on_exit()
+    audio_recorder.on_exit()
+    return result
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="omband timing benchmark, with fake midi ports and a virtual audio device")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "omband.conf"))
+    parser.add_argument("--tracks", type=int, nargs="+", default=[1, 8, 32], help="midi tracks (and as many audio loops)")
+    parser.add_argument("--density", type=int, nargs="+", default=[4, 16], help="notes per beat in every midi track")
+    parser.add_argument("--ticks-per-beat", type=int, nargs="+", default=[192, 960])
+    parser.add_argument("--bpm", type=int, nargs="+", default=[120, 240])
+    parser.add_argument("--ports", type=int, nargs="+", default=[1], help="midi output ports the tracks are spread over")
+    parser.add_argument("--seconds", type=float, default=2.0, help="playing time of every case")
+    parser.add_argument("--bars", type=int, default=2, help="length of the loops")
+    parser.add_argument("--output", help="write the JSON to this file instead of the standard output")
+    return parser.parse_args()
+
+
+def main():
+    arguments = parse_arguments()
+    install_fake_ports()
+    config = cls.load_config(arguments.config)
+    directory = os.path.dirname(os.path.abspath(__file__))
+    config.set_override("Ports", "input_device", "bench")
+    config.set_override("Ports", "output_device", "bench")
+    config.set_override("Midi", "file_to_load", os.path.join(directory, "metronome.midi"))
+    config.set_override("Clock", "threaded", "yes")
+    config.set_override("Clock", "source", "internal")
+    config.set_override("Clock", "send_midi_clock", "no")
+    config.set_override("Audio", "process", "no") # The virtual audio device replaces PyAudio in this process
+
+    results = []
+    for tracks, density, ticks_per_beat, bpm, ports in itertools.product(arguments.tracks, arguments.density, arguments.ticks_per_beat, arguments.bpm, arguments.ports):
+        result = run_case(tracks, density, ticks_per_beat, bpm, ports, arguments.seconds, arguments.bars)
+        print(json.dumps(result), file=sys.stderr)
+        results.append(result)
+
+    report = {"python": platform.python_version(), "machine": platform.machine(), "system": platform.system(), "results": results}
+    if arguments.output is not None:
+        with open(arguments.output, "w") as output_file:
+            json.dump(report, output_file, indent=1)
+    else:
+        print(json.dumps(report, indent=1))
+
+
+if __name__ == "__main__":
+    main()
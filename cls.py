@@ -16,14 +16,128 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import time
+import math
+import threading
 import configparser
-import copy
 import wave
 import os
-
-import pyaudio
-import mido
-import pygame
+import re
+import collections
+import array
+import struct
+import itertools
+import json
+import importlib
+import signal
+import zlib
+
+
+# This class stands for a module that is only imported the first time one of its attributes is used (or when load() is called). pyaudio, mido and numpy
+# take a while to import, so importing cls is immediate and they can be loaded on another thread (preload_backends) while the interface starts
+class LazyModule:
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    # Only called for attributes that aren't in the instance yet. They're kept in it, so the next time there's no extra cost
+    def __getattr__(self, attribute):
+        if attribute == "module":
+            raise AttributeError(attribute)
+        value = getattr(self.load(), attribute)
+        setattr(self, attribute, value)
+        return value
+
+
+pyaudio = LazyModule("pyaudio")
+mido = LazyModule("mido")
+numpy = LazyModule("numpy")
+multiprocessing = LazyModule("multiprocessing")
+shared_memory = LazyModule("multiprocessing.shared_memory")
+
+
+# This class keeps how long every step of the start took, from the moment it's created (main.py creates it first thing). The time waiting for the user
+# (ConfInit) is left out of the total
+class StartupTimer:
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.last_time = self.start_time
+        self.steps = [] # (name, seconds)
+        self.parallel_steps = [] # Steps done on other threads at the same time (name, seconds)
+        self.excluded = 0.0
+        self.ready_time = None
+
+    def mark(self, name, is_excluded=False):
+        now = time.perf_counter()
+        self.steps.append((name, now - self.last_time))
+        if is_excluded:
+            self.excluded += now - self.last_time
+        self.last_time = now
+
+    def add_parallel(self, name, seconds):
+        self.parallel_steps.append((name, seconds))
+
+    def ready(self):
+        self.mark("ready")
+        self.ready_time = self.last_time
+
+    def get_total_ms(self):
+        end_time = self.ready_time if self.ready_time is not None else time.perf_counter()
+        return round((end_time - self.start_time - self.excluded) * 1000)
+
+    def report(self):
+        steps = ", ".join(name + " " + str(round(seconds * 1000)) for name, seconds in self.steps)
+        parallel_steps = ", ".join(name + " " + str(round(seconds * 1000)) for name, seconds in self.parallel_steps)
+        if parallel_steps:
+            steps += "; in parallel: " + parallel_steps
+        return "startup " + str(self.get_total_ms()) + "ms (" + steps + ")"
+
+
+startup = StartupTimer()
+
+# There's a single PyAudio for the whole program, as PyAudio() probes every audio device. preload_backends() makes it in the background. With
+# [Audio] process = yes, it's an AudioProcess, which has the same methods but keeps the streams in another process
+portaudio = None
+portaudio_lock = threading.Lock()
+
+def get_portaudio():
+    global portaudio
+    with portaudio_lock:
+        if portaudio is None:
+            config = get_config()
+            if config.is_audio_process:
+                portaudio = AudioProcess(config.audio_process_lead_ms)
+            else:
+                portaudio = pyaudio.PyAudio()
+        return portaudio
+
+def terminate_portaudio():
+    global portaudio
+    with portaudio_lock:
+        if portaudio is not None:
+            portaudio.terminate()
+            portaudio = None
+
+# This one imports numpy, mido (and its midi backend) and pyaudio, and initializes PortAudio, on a thread, so it's done while the rest starts.
+# Whatever needs them before they're ready just waits for the import (or the PyAudio) to finish
+def preload_backends():
+    def run():
+        start_time = time.perf_counter()
+        numpy.load()
+        mido.load()
+        try:
+            mido.backend.load()
+        except ImportError:
+            pass # The ports will fail to open, and the MidiPortPool will keep trying, as usual
+        get_portaudio()
+        startup.add_parallel("backends", time.perf_counter() - start_time)
+    thread = threading.Thread(target=run, name="omband-preload", daemon=True)
+    thread.start()
+    return thread
 
 
 # These are some functions that will be used later.
@@ -42,35 +156,88 @@ def extract_tempo_from_track(midi_file):
                 return bpm
     return 0
 
-# This one extracts a list of all the messages in a midi_track
-def extract_msgs_from_midi_track(midi_track):
-    msgs = []
-    for msg in midi_track:
-        msgs.append(msg)
-    return msgs
-
-# This one extracts the absolute time from a midi_track (according to the tempo)
-def extract_absolute_msgs_from_midi_track(midi_track, ticks_per_beat, new_ticks_per_beat):
-    msgs = []
+# This one extracts the messages of a midi_track into a MidiEventStore, with absolute times (according to the tempo)
+def extract_events_from_midi_track(midi_track, ticks_per_beat, new_ticks_per_beat):
+    events = MidiEventStore()
     absolute_time = 0
     for msg in midi_track:
         absolute_time = absolute_time + msg.time
-        temp_msg = copy.copy(msg)
-        temp_msg.time = absolute_time/(ticks_per_beat/new_ticks_per_beat)
-        if temp_msg.time == 0 and not temp_msg.is_meta:
-            temp_msg.time = 1 # This changes de 0 time of the first note_on message in order to avoid skipping the first note.
-        msgs.append(temp_msg)
-    return msgs
-
-# This one returns the midi messages with the corrected time (relative time between messages)
-def absolute_msgs_to_midi_track(midi_track):
-    msgs = []
-    for i in range(len(midi_track.msgs)):
-        new_msg = copy.copy(midi_track.msgs[i])
-        if i > 0:
-            new_msg.time = (midi_track.msgs[i].time - midi_track.msgs[i-1].time)
-        msgs.append(new_msg)
-    return msgs
+        tick = absolute_time/(ticks_per_beat/new_ticks_per_beat)
+        if tick == 0 and not msg.is_meta:
+            tick = 1 # This changes de 0 time of the first note_on message in order to avoid skipping the first note.
+        events.append(msg, tick)
+    return events
+
+# This one yields the midi messages of a MidiEventStore with the corrected time (relative time between messages)
+def absolute_msgs_to_midi_track(events):
+    previous_tick = 0
+    for tick, msg in events.iter_messages():
+        tick = max(previous_tick, round(tick)) # Midi files only have whole ticks
+        yield msg.copy(time=tick - previous_tick)
+        previous_tick = tick
+
+# This one maps the samples of a 16 bit wave file into memory (without reading them). The pages are read from the disk (or the page cache) when they are
+# played, so long takes don't use memory of their own and don't take time to load
+def map_wave_samples(file_path):
+    with open(file_path, 'rb') as wave_file:
+        header = wave_file.read(12)
+        if len(header) < 12 or header[0:4] != b'RIFF' or header[8:12] != b'WAVE':
+            raise ValueError(file_path + " is not a wave file")
+
+        sample_width = None
+        while True:
+            chunk_header = wave_file.read(8)
+            if len(chunk_header) < 8:
+                raise ValueError(file_path + " has no data chunk")
+            chunk_id = chunk_header[0:4]
+            chunk_size = int.from_bytes(chunk_header[4:8], "little")
+            if chunk_id == b'fmt ':
+                fmt = wave_file.read(chunk_size)
+                sample_width = int.from_bytes(fmt[14:16], "little") // 8
+                wave_file.seek(chunk_size % 2, os.SEEK_CUR)
+            elif chunk_id == b'data':
+                data_offset = wave_file.tell()
+                break
+            else:
+                wave_file.seek(chunk_size + chunk_size % 2, os.SEEK_CUR) # Chunks are padded to an even size
+
+        file_size = os.fstat(wave_file.fileno()).st_size
+
+    if sample_width != 2:
+        raise ValueError(file_path + " is not a 16 bit wave file")
+    samples = min(chunk_size, file_size - data_offset) // 2
+    if samples == 0:
+        return numpy.zeros(0, dtype=numpy.int16)
+    return numpy.memmap(file_path, dtype='<i2', mode='r', offset=data_offset, shape=(samples,))
+
+# This one maps a raw file of 16 bit little endian samples (the takes of a Session)
+def map_pcm_samples(file_path):
+    if os.path.getsize(file_path) < 2:
+        return numpy.zeros(0, dtype=numpy.int16)
+    return numpy.memmap(file_path, dtype='<i2', mode='r')
+
+# This one returns the samples of a take file: a CompressedSamples for a compressed take (.omz), and the samples mapped into memory for the others.
+# The first trim samples are left out (or as many zeros are put before them, if it's negative), see AudioRecorder.close_take
+def map_take_samples(file_path, trim=0):
+    if file_path.endswith(".omz"):
+        return CompressedSamples(file_path, trim)
+    if file_path.endswith(".pcm"):
+        return trim_samples(map_pcm_samples(file_path), trim)
+    return trim_samples(map_wave_samples(file_path), trim)
+
+def trim_samples(samples, trim):
+    if trim >= 0:
+        return samples[trim:]
+    return numpy.concatenate((numpy.zeros(-trim, dtype=numpy.int16), samples))
+
+# The takes keep everything that was recorded (outputN.wav or outputN.omz), and outputN.json has what's needed to play them: the frames recorded before
+# the first tick ("trim_frames") and the ticks of the loop ("final_tick"). This one reads it for a take file, or returns None if there isn't one
+def read_take_info(file_path):
+    try:
+        with open(os.path.splitext(file_path)[0] + ".json") as info_file:
+            return json.load(info_file)
+    except (OSError, ValueError):
+        return None
 
 # This one transforms the bpm to ms_per_beat
 def bpm_to_ms_per_beat(bpm):
@@ -79,34 +246,192 @@ def bpm_to_ms_per_beat(bpm):
 
 # This function returns a value from the config file
 def string_to_config_parser(content_to_parse):
-    config = configparser.ConfigParser()
-    config.read("omband.conf")
-    return config[content_to_parse[0]][content_to_parse[1]]
+    return get_config().get(content_to_parse[0], content_to_parse[1])
+
+# This one returns the configuration, reading omband.conf only the first time it's called
+def get_config():
+    global config
+    if config is None:
+        config = Config()
+    return config
+
+# This one replaces the configuration with the one in config_path
+def load_config(config_path):
+    global config
+    config = Config(config_path)
+    return config
+
+
+# This class holds the configuration of omband.conf. The file is read once and kept in memory, with typed values as attributes.
+# Any value can be overridden from the command line (set_override) or from the environment (OMBAND_<SECTION>_<OPTION>, e.g. OMBAND_MIDI_BPM)
+class Config:
+    def __init__(self, config_file_path="omband.conf"):
+        self.config_file_path = config_file_path
+        self.parser = configparser.ConfigParser()
+        self.overrides = {}
+        self.mtime = None
+
+        self.input_device = None
+        self.output_device = None
+        self.bpm = 120
+        self.ticks_per_beat = 192
+        self.file_to_load = "metronome.midi"
+        self.is_clock_threaded = True
+        self.spin_ms = 0.5
+        self.lookahead_ms = 30.0
+        self.sender_priority = 0
+        self.ring_buffer_seconds = 10.0
+        self.write_batch_ms = 250
+        self.mixdown_bars = 0
+        self.frames_per_buffer = 512
+        self.latency_ms = 0.0
+        self.calibration_note = 60
+        self.is_audio_process = False
+        self.audio_process_lead_ms = 100.0
+        self.is_compressing_takes = False
+        self.fps = 30
+        self.quantize_grid = 48
+        self.port_check_interval = 1.0
+        self.clock_source = "internal"
+        self.is_sending_midi_clock = False
+        self.pll_bandwidth = 1.0
+        self.session_directory = "session"
+        self.is_restoring_session = True
+        self.control_map = {} # Number of a midi control change -> headless command
+        self.outputs = {} # Name of an output -> its port. "main" is [Ports] output_device, the others come from [Outputs]
+        self.routes = {} # Id (as a string) or lowercase name of a midi track -> name of its output, from [Routing]
+
+        self.reload()
+
+    def reload(self):
+        parser = configparser.ConfigParser()
+        parser.read(self.config_file_path)
+        self.parser = parser
+        self.mtime = self.get_mtime()
+        self.update_values()
+
+    # This method reloads the file only if it was modified since the last time it was read. It returns whether it did
+    def reload_if_changed(self):
+        if self.get_mtime() != self.mtime:
+            self.reload()
+            return True
+        return False
+
+    def get_mtime(self):
+        try:
+            return os.stat(self.config_file_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def set_override(self, section, option, value):
+        self.overrides[(section, option)] = str(value)
+        self.update_values()
+
+    def clear_overrides(self, section):
+        for key in [key for key in self.overrides if key[0] == section]:
+            del self.overrides[key]
+        self.update_values()
+
+    def get(self, section, option, fallback=None):
+        if (section, option) in self.overrides:
+            return self.overrides[(section, option)]
+        env_name = "OMBAND_" + section.upper() + "_" + option.upper()
+        if env_name in os.environ:
+            return os.environ[env_name]
+        return self.parser.get(section, option, fallback=fallback)
+
+    # This one returns every option of a section, with the overrides (for sections whose options aren't known beforehand, like [Control])
+    def get_section(self, section):
+        values = {}
+        if self.parser.has_section(section):
+            values.update(self.parser.items(section))
+        for (override_section, option), value in self.overrides.items():
+            if override_section == section:
+                values[option] = value
+        return values
+
+    def get_int(self, section, option, fallback):
+        value = self.get(section, option)
+        if value is None:
+            return fallback
+        return int(value)
+
+    def get_float(self, section, option, fallback):
+        value = self.get(section, option)
+        if value is None:
+            return fallback
+        return float(value)
+
+    def get_boolean(self, section, option, fallback):
+        value = self.get(section, option)
+        if value is None:
+            return fallback
+        if value.lower() not in self.parser.BOOLEAN_STATES:
+            raise ValueError("Not a boolean: " + section + "." + option + " = " + value)
+        return self.parser.BOOLEAN_STATES[value.lower()]
+
+    def update_values(self):
+        self.input_device = self.get("Ports", "input_device")
+        self.output_device = self.get("Ports", "output_device")
+        self.bpm = self.get_int("Midi", "bpm", 120)
+        self.ticks_per_beat = self.get_int("Midi", "ticks_per_beat", 192)
+        self.file_to_load = self.get("Midi", "file_to_load", "metronome.midi")
+        self.is_clock_threaded = self.get_boolean("Clock", "threaded", True)
+        self.spin_ms = self.get_float("Clock", "spin_ms", 0.5)
+        self.lookahead_ms = self.get_float("Clock", "lookahead_ms", 30.0)
+        self.sender_priority = self.get_int("Clock", "sender_priority", 0)
+        self.ring_buffer_seconds = self.get_float("Audio", "ring_buffer_seconds", 10.0)
+        self.write_batch_ms = self.get_int("Audio", "write_batch_ms", 250)
+        self.mixdown_bars = self.get_int("Audio", "mixdown_bars", 0)
+        self.frames_per_buffer = self.get_int("Audio", "frames_per_buffer", 512)
+        self.latency_ms = self.get_float("Audio", "latency_ms", 0.0)
+        self.calibration_note = self.get_int("Audio", "calibration_note", 60)
+        self.is_audio_process = self.get_boolean("Audio", "process", False)
+        self.audio_process_lead_ms = self.get_float("Audio", "process_lead_ms", 100.0)
+        self.is_compressing_takes = self.get_boolean("Audio", "compress_takes", False)
+        self.fps = self.get_int("Gui", "fps", 30)
+        self.quantize_grid = self.get_int("Midi", "quantize_grid", self.ticks_per_beat // 4)
+        self.port_check_interval = self.get_float("Ports", "check_interval", 1.0)
+        self.clock_source = self.get("Clock", "source", "internal")
+        self.is_sending_midi_clock = self.get_boolean("Clock", "send_midi_clock", False)
+        self.pll_bandwidth = self.get_float("Clock", "pll_bandwidth", 1.0)
+        self.session_directory = self.get("Session", "directory", "session")
+        self.is_restoring_session = self.get_boolean("Session", "restore", True)
+        self.control_map = {}
+        for option, value in self.get_section("Control").items():
+            match = re.fullmatch(r"cc(\d+)", option)
+            if match:
+                self.control_map[int(match.group(1))] = value
+        self.outputs = self.get_section("Outputs")
+        self.outputs["main"] = self.output_device
+        self.routes = dict((option.lower(), value) for option, value in self.get_section("Routing").items())
+
+
+config = None
 
 
 
 # This class is the initial configuration screen
 class ConfInit:
     def __init__(self):
-        self.config_file_path = "omband.conf"
         self.bpm = 120
         self.ticks_per_beat = 0
 
         self.input_device_string = ""
         self.output_device_string = ""
 
-        self.config = configparser.ConfigParser()
-        self.config.read(self.config_file_path)
+        self.config = get_config()
+        self.config_file_path = self.config.config_file_path
 
     def show_config_file(self):
-        print("There's an omband.conf file. We found the next configuration:\n")
+        print("There's an " + self.config_file_path + " file. We found the next configuration:\n")
         print("Ports:")
-        print(" Input_device = " + self.config["Ports"]["input_device"])
-        print(" Output_device = " + self.config["Ports"]["output_device"])
+        print(" Input_device = " + str(self.config.input_device))
+        print(" Output_device = " + str(self.config.output_device))
         print("Midi:")
-        print(" bpm = " + self.config["Midi"]["bpm"])
-        print(" Ticks per beat (192 by default) = " + self.config["Midi"]["ticks_per_beat"])
-        print(" File to load ('metronome.midi' by default) = " + self.config["Midi"]["file_to_load"])
+        print(" bpm = " + str(self.config.bpm))
+        print(" Ticks per beat (192 by default) = " + str(self.config.ticks_per_beat))
+        print(" File to load ('metronome.midi' by default) = " + self.config.file_to_load)
 
         command_is_valid = False
         while not command_is_valid:
@@ -129,107 +454,641 @@ class ConfInit:
         self.show_config_file()
 
 
+# This one finds name among the available port names. If it isn't there, it looks for a port with the same name but other client:port numbers,
+# because ALSA can give new numbers to a device when it's plugged again
+def find_port_name(name, available_names):
+    if name in available_names:
+        return name
+    base_name = re.sub(r" \d+:\d+$", "", name)
+    for available_name in available_names:
+        if re.sub(r" \d+:\d+$", "", available_name) == base_name:
+            return available_name
+    return None
+
+
+# This class is a midi output port that is opened once and can survive being disconnected. While it's disconnected, messages are dropped (and counted).
+# The MidiPortPool reconnects it when the device comes back
+class MidiOutput:
+    def __init__(self, name):
+        self.name = name
+        self.port = None
+        self.dropped = 0
+
+    def is_connected(self):
+        return self.port is not None
+
+    def open(self, port_name):
+        self.port = mido.open_output(port_name)
+
+    def disconnect(self):
+        port = self.port
+        self.port = None
+        if port is not None:
+            try:
+                port.close()
+            except Exception:
+                pass
+
+    def send(self, msg):
+        port = self.port
+        if port is None:
+            self.dropped += 1
+            return
+        try:
+            port.send(msg)
+        except Exception:
+            self.dropped += 1
+            self.disconnect()
+
+    def reset(self):
+        if self.port is not None:
+            try:
+                self.port.reset()
+            except Exception:
+                self.disconnect()
+
+    def panic(self):
+        if self.port is not None:
+            try:
+                self.port.panic()
+            except Exception:
+                self.disconnect()
+
+
+# This class is a midi input port that is opened once and stays open. Whoever wants its messages adds a listener (a callable that receives the message),
+# which is called from mido's thread
+class MidiInput:
+    def __init__(self, name):
+        self.name = name
+        self.port = None
+        self.listeners = []
+
+    def is_connected(self):
+        return self.port is not None
+
+    def open(self, port_name):
+        self.port = mido.open_input(port_name, callback=self.on_message)
+
+    def disconnect(self):
+        port = self.port
+        self.port = None
+        if port is not None:
+            try:
+                port.close()
+            except Exception:
+                pass
+
+    def on_message(self, msg):
+        for listener in self.listeners:
+            listener(msg)
+
+    def add_listener(self, listener):
+        if listener not in self.listeners:
+            self.listeners = self.listeners + [listener] # A new list, so on_message never sees it change
+
+    def remove_listener(self, listener):
+        self.listeners = [other for other in self.listeners if other != listener]
+
+
+# This class opens the midi ports once and keeps them warm, handing the same MidiInput/MidiOutput to whoever asks for a port. A thread checks every
+# check_interval seconds that the devices are still there, closing the ports that disappeared and opening again the ones that came back
+class MidiPortPool:
+    def __init__(self, check_interval=1.0):
+        self.inputs = {}
+        self.outputs = {}
+        self.check_interval = check_interval
+
+        self.lock = threading.Lock()
+        self.thread = None
+        self.is_running = False
+
+    def get_input(self, name):
+        with self.lock:
+            if name not in self.inputs:
+                self.inputs[name] = MidiInput(name)
+                self.connect(self.inputs[name], mido.get_input_names)
+            return self.inputs[name]
+
+    def get_output(self, name):
+        with self.lock:
+            if name not in self.outputs:
+                self.outputs[name] = MidiOutput(name)
+                self.connect(self.outputs[name], mido.get_output_names)
+            return self.outputs[name]
+
+    # This method opens the port if its device is there. It returns whether the port is connected
+    def connect(self, port, get_names):
+        try:
+            if port.name is None:
+                port.open(None) # The default port of the backend
+            else:
+                port_name = find_port_name(port.name, get_names())
+                if port_name is None:
+                    return False
+                port.open(port_name)
+        except Exception:
+            port.disconnect()
+            return False
+        return True
+
+    def check(self):
+        with self.lock:
+            for ports, get_names in ((self.inputs, mido.get_input_names), (self.outputs, mido.get_output_names)):
+                try:
+                    names = get_names()
+                except Exception:
+                    continue
+                for port in ports.values():
+                    if port.is_connected() and port.name is not None and find_port_name(port.name, names) is None:
+                        port.disconnect()
+                    elif not port.is_connected():
+                        self.connect(port, get_names)
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="omband-midi-ports", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.is_running:
+            time.sleep(self.check_interval)
+            self.check()
+
+    def close(self):
+        self.is_running = False
+        with self.lock:
+            for port in list(self.inputs.values()) + list(self.outputs.values()):
+                port.disconnect()
+
+
+# This class hands the midi messages to a MidiSender per port, which sends them at the time they're due. Whoever produces them (the MidiManager,
+# lookahead_ms ahead of the clock) opens a batch with the target time of a tick (begin_tick), sends to ScheduledOutputs, and closes it (end_tick). All
+# the messages of a tick for a port go in a single batch. Every port has its own queue and thread, so a slow or busy port doesn't delay the others
+class MidiScheduler:
+    def __init__(self, spin_ms=0.5, priority=0):
+        self.spin_ms = spin_ms
+        self.priority = priority
+
+        self.senders = {} # output_device -> MidiSender
+        self.target_time = None
+        self.pending = {} # output_device -> [msgs] of the tick being produced
+        self.is_running = False
+
+    # Outputs with different names can be the same port (the MidiPortPool hands out one MidiOutput per port), and then they share the sender
+    def get_output(self, output_device, name="main"):
+        if output_device not in self.senders:
+            sender = MidiSender(output_device, name, self.spin_ms, self.priority)
+            self.senders[output_device] = sender
+            if self.is_running:
+                sender.start()
+        return ScheduledOutput(self, output_device)
+
+    def get_senders(self):
+        return list(self.senders.values())
+
+    # This one returns the lateness of every sender in a single histogram
+    def get_lateness(self):
+        lateness = LatencyHistogram()
+        for sender in self.get_senders():
+            lateness.merge(sender.lateness)
+        return lateness
+
+    def start(self):
+        self.is_running = True
+        for sender in self.get_senders():
+            sender.start()
+
+    def stop(self):
+        self.is_running = False
+        for sender in self.get_senders():
+            sender.stop()
+
+    def begin_tick(self, target_time):
+        self.target_time = target_time
+
+    def send(self, output_device, msg):
+        if self.target_time is None:
+            output_device.send(msg) # Out of a tick (e.g. start and stop), it's sent right away
+            return
+        msgs = self.pending.get(output_device)
+        if msgs is None:
+            msgs = self.pending[output_device] = []
+        msgs.append(msg)
+
+    def end_tick(self):
+        if self.pending:
+            for output_device, msgs in self.pending.items():
+                self.senders[output_device].put(self.target_time, msgs)
+            self.pending = {}
+        self.target_time = None
+
+    # This method drops everything that hasn't been sent yet (when the transport stops)
+    def clear(self):
+        for sender in self.get_senders():
+            sender.clear()
+        self.pending = {}
+        self.target_time = None
+
+
+# This class sends the batches of one port from its own thread. It sleeps until a little before the target of the next batch and spins the rest, like
+# the ClockEngine, and keeps how late every batch was sent, how many messages it sent and how many are waiting (the backlog). If priority > 0, it tries
+# to run with that real time priority (SCHED_FIFO), which usually needs permissions, so it may not get it
+class MidiSender:
+    def __init__(self, output_device, name, spin_ms=0.5, priority=0):
+        self.output_device = output_device
+        self.name = name
+        self.spin_ns = int(spin_ms * 1000000)
+        self.priority = priority
+        self.is_realtime = False
+
+        self.queue = collections.deque() # (target ns, generation, [msgs]), in order of target
+        self.condition = threading.Condition()
+        self.generation = 0 # Changes when the queue is cleared, so a batch that was being waited for is dropped
+
+        self.lateness = LatencyHistogram()
+        self.sent = 0
+        self.backlog = 0 # Messages in the queue
+        self.max_backlog = 0
+        self.rate_sent = 0
+        self.rate_time = time.perf_counter_ns()
+
+        self.thread = None
+        self.is_running = False
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="omband-midi-sender-" + self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def put(self, target_time, msgs):
+        with self.condition:
+            self.queue.append((target_time, self.generation, msgs))
+            self.backlog += len(msgs)
+            if self.backlog > self.max_backlog:
+                self.max_backlog = self.backlog
+            self.condition.notify()
+
+    def clear(self):
+        with self.condition:
+            self.queue.clear()
+            self.backlog = 0
+            self.generation += 1
+            self.condition.notify()
+
+    # This method returns the messages sent per second since the last time it was called
+    def get_rate(self):
+        now = time.perf_counter_ns()
+        sent = self.sent
+        rate = (sent - self.rate_sent) * 1000000000 / max(1, now - self.rate_time)
+        self.rate_sent, self.rate_time = sent, now
+        return rate
+
+    def summary(self):
+        return self.name + " " + self.lateness.summary() + " sent " + str(self.sent) + " backlog " + str(self.backlog) + "/" + str(self.max_backlog)
+
+    def set_priority(self):
+        if self.priority > 0 and hasattr(os, "sched_setscheduler"):
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(self.priority))
+                self.is_realtime = True
+            except (OSError, ValueError):
+                self.is_realtime = False
+
+    def run(self):
+        self.set_priority()
+        while True:
+            with self.condition:
+                while self.is_running and not self.queue:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                target_time, generation = self.queue[0][0], self.queue[0][1]
+
+            remaining = target_time - time.perf_counter_ns()
+            if remaining > self.spin_ns:
+                with self.condition:
+                    self.condition.wait((remaining - self.spin_ns) / 1000000000) # clear() and stop() wake it up
+                continue
+            while time.perf_counter_ns() < target_time:
+                time.sleep(0)
+
+            with self.condition:
+                if not self.queue or self.queue[0][1] != generation or self.queue[0][0] != target_time:
+                    continue
+                target_time, generation, msgs = self.queue.popleft()
+                self.backlog -= len(msgs)
+            start = time.perf_counter_ns()
+            for msg in msgs:
+                self.output_device.send(msg)
+            self.sent += len(msgs)
+            self.lateness.add(start - target_time)
+            probes.record("MidiSender.send", start)
+
+
+# This class looks like a MidiOutput to the tracks, but the messages go through a MidiScheduler
+class ScheduledOutput:
+    def __init__(self, scheduler, output_device):
+        self.scheduler = scheduler
+        self.output_device = output_device
+
+    def send(self, msg):
+        self.scheduler.send(self.output_device, msg)
+
+
+# This class keeps the midi messages of a track in compact parallel arrays: tick (which can be fractional), status, data1 and data2. Meta and sysex
+# messages, which are few, are kept as mido messages in a side table. Channel messages only become mido messages when they are sent
+class MidiEventStore:
+    def __init__(self):
+        self.ticks = array.array('d')
+        self.statuses = array.array('B')
+        self.data1 = array.array('B')
+        self.data2 = array.array('B')
+        self.others = [] # (tick, msg)
+
+    def __len__(self):
+        return len(self.ticks)
+
+    def append(self, msg, tick):
+        if msg.is_meta or msg.type == "sysex" or msg.bytes()[0] >= 0xF0:
+            self.others.append((tick, msg))
+            return
+        msg_bytes = msg.bytes()
+        self.ticks.append(tick)
+        self.statuses.append(msg_bytes[0])
+        self.data1.append(msg_bytes[1])
+        self.data2.append(msg_bytes[2] if len(msg_bytes) > 2 else 0)
+
+    def get_bytes(self, index):
+        status = self.statuses[index]
+        if status & 0xF0 in (0xC0, 0xD0): # Program change and channel pressure only have one data byte
+            return [status, self.data1[index]]
+        return [status, self.data1[index], self.data2[index]]
+
+    def get_message(self, index):
+        return mido.Message.from_bytes(self.get_bytes(index))
+
+    # This method yields (tick, msg) for every message, ordered by tick
+    def iter_messages(self):
+        others = sorted(self.others, key=lambda other: other[0])
+        other_index = 0
+        for index in range(len(self.ticks)):
+            # Meta messages go after the channel messages of the same tick, so end_of_track is always the last one
+            while other_index < len(others) and others[other_index][0] < self.ticks[index]:
+                yield others[other_index]
+                other_index += 1
+            yield self.ticks[index], self.get_message(index)
+        while other_index < len(others):
+            yield others[other_index]
+            other_index += 1
+
+    # This method returns a copy that can be read by other threads while this one changes (quantize)
+    def copy(self):
+        events = MidiEventStore()
+        events.ticks = self.ticks[:]
+        events.statuses = self.statuses[:]
+        events.data1 = self.data1[:]
+        events.data2 = self.data2[:]
+        events.others = list(self.others)
+        return events
+
+    # This method orders the channel messages by tick (keeping the order of the messages with the same tick)
+    def sort(self):
+        order = sorted(range(len(self.ticks)), key=self.ticks.__getitem__)
+        self.ticks = array.array('d', [self.ticks[index] for index in order])
+        self.statuses = array.array('B', [self.statuses[index] for index in order])
+        self.data1 = array.array('B', [self.data1[index] for index in order])
+        self.data2 = array.array('B', [self.data2[index] for index in order])
+        self.others.sort(key=lambda other: other[0])
+
+
 # This class will be the one in charge to record a new midi track
 class MidiRecorder:
-    def __init__(self, tracks):
-        self.input_device = None
+    def __init__(self, tracks, track_registry, input_device):
+        self.input_device = input_device # A MidiInput from the MidiPortPool, which is always open
         self.tracks = tracks
+        self.track_registry = track_registry
 
-        self.temp_midi_track = None
+        self.temp_events = None
         self.temp_track = None
 
+        # mido calls on_message from its own thread. The messages wait here, with the time they arrived, until the recorder reads them
+        self.input_queue = collections.deque()
+        self.start_tick = 0
+
         self.relative_tick = 0
         self.is_active = False
         self.is_recording = False
         self.is_changing_active_state = False
 
-    # This method appends the midi messages from the input device to self.temp_midi_track
+    def on_message(self, msg):
+        self.input_queue.append((time.perf_counter_ns(), msg))
+
+    # This method converts the time a message arrived to a tick of the recording. It isn't rounded, so the recording keeps the feel of the performance
+    def timestamp_to_tick(self, timestamp, clock):
+        return max(1, clock.get_tick_at(timestamp) - self.start_tick + 1)
+
+    # This method appends the midi messages from the input device to self.temp_events
     def record(self, clock):
         if self.is_active and self.is_recording:
             if clock.just_ticked:
                 self.relative_tick += 1
+            self.read_input(clock)
 
-            for msg in self.input_device.iter_pending():
-                if not msg.type == "clock":
-                    msg.time = self.relative_tick
-                    self.temp_midi_track.append(msg)
+    def read_input(self, clock):
+        while self.input_queue:
+            timestamp, msg = self.input_queue.popleft()
+            if not msg.type == "clock":
+                self.temp_events.append(msg, self.timestamp_to_tick(timestamp, clock))
 
     def update(self, clock):
         self.change_state_check(clock)
         self.record(clock)
 
     # This method stops the recording. It gives a name to the new midi track, it puts a final_tick to it and it adds a final meta message, "end of track". After that, it resets some variables.
-    def stop_recording(self):
-        self.temp_midi_track.name = "NewMidiRec"
-        self.temp_track = TrackMidi(midi_track=self.temp_midi_track)
-        self.temp_track.final_tick = self.relative_tick
-        msg = mido.MetaMessage("end_of_track", time=self.relative_tick)
-        self.temp_track.msgs.append(msg)
+    def stop_recording(self, clock):
+        self.input_device.remove_listener(self.on_message)
+        self.read_input(clock)
+        self.temp_events.append(mido.MetaMessage("end_of_track"), self.relative_tick)
+        self.temp_track = TrackMidi(events=self.temp_events, name="NewMidiRec")
 
         self.temp_track.is_active = True
         self.tracks.append(self.temp_track)
+        self.track_registry.add(self.temp_track)
 
         self.temp_track = None
-        self.temp_midi_track = None
+        self.temp_events = None
 
         self.relative_tick = 0
         self.is_active = False
         self.is_recording = False
-        self.input_device.close()
 
-    def change_active_state(self):
+    def change_active_state(self, clock):
         if self.is_recording:
-            self.stop_recording()
+            self.stop_recording(clock)
         elif not self.is_recording:
-            self.temp_midi_track = mido.MidiTrack()
+            self.temp_events = MidiEventStore()
             self.is_active = True
             self.is_recording = True
-            self.input_device = mido.open_input(string_to_config_parser(["Ports", "input_device"]))
+            self.start_tick = clock.absolute_tick
+            self.input_queue.clear()
+            self.input_device.add_listener(self.on_message)
 
     # This method checks, at the beginning of each beat number1 whether it's necessary to change the state to active/inactive
     def change_state_check(self, clock):
         if clock.relative_tick == 1 and clock.beat == 1 and self.is_changing_active_state:
             self.is_changing_active_state = False
-            self.change_active_state()
+            self.change_active_state(clock)
 
 
 # This class is only a parent to other two classes: TrackMidi and TrackAudio
 class Track:
     def __init__(self):
         self.type = ""
+        self.registry = None
+
+    # Tracks tell their registry when their state changes, so the UI only has to look at them
+    def notify_change(self):
+        if self.registry is not None:
+            self.registry.notify(self)
+
+    # This method is called when the user presses the key of the track. If it's playing, the change waits until the end of the loop
+    def toggle_active_state(self, is_playing):
+        if not is_playing:
+            self.is_changing_active_state = False
+            self.change_active_state()
+        elif not self.is_changing_active_state:
+            self.is_changing_active_state = True
+            self.notify_change()
+        elif self.is_changing_active_state:
+            self.is_changing_active_state = False
+            self.notify_change()
+
+
+# This class keeps every track (MIDI and audio) by its id_num, which is also the key that activates/deactivates it. Listeners (callables that receive a track)
+# are called whenever a track is added, removed or changes its state. They can be called from any thread but the audio callbacks, which only queue the track
+# with notify_later, and the clock thread calls the listeners for it (flush)
+class TrackRegistry:
+    def __init__(self):
+        self.tracks = {}
+        self.listeners = []
+        self.pending = collections.deque()
+
+    # A restored track keeps its id_num
+    def add(self, track, id_num=None):
+        if id_num is None:
+            id_num = max(self.tracks, default=0) + 1
+        track.id_num = id_num
+        track.registry = self
+        self.tracks[track.id_num] = track
+        self.notify(track)
+
+    def remove(self, track):
+        if self.tracks.get(track.id_num) is track:
+            del self.tracks[track.id_num]
+            track.registry = None
+            self.notify(track)
+
+    def get(self, id_num):
+        return self.tracks.get(id_num)
+
+    # This method returns a copy of the tracks, ordered by id_num, so it can be iterated while other threads add tracks
+    def get_tracks(self):
+        return list(self.tracks.values())
 
+    def subscribe(self, listener):
+        self.listeners.append(listener)
 
-# This is a TrackMidi. Its main purpose is to send the messages it has to the output device
+    def notify(self, track):
+        for listener in self.listeners:
+            listener(track)
+
+    def notify_later(self, track):
+        self.pending.append(track)
+
+    def flush(self):
+        while self.pending:
+            self.notify(self.pending.popleft())
+
+
+# This is a TrackMidi. Its main purpose is to send the messages it has to the output device. It's loaded from a midi_track of a file, or made from the
+# events (a MidiEventStore) of a recording
 class TrackMidi(Track):
-    def __init__(self, midi_track=None, ticks_per_beat=int(string_to_config_parser(["Midi", "ticks_per_beat"]))):
+    def __init__(self, midi_track=None, ticks_per_beat=None, events=None, name=""):
+        if ticks_per_beat is None:
+            ticks_per_beat = get_config().ticks_per_beat
         self.ticks_per_beat = ticks_per_beat
         self.new_ticks_per_beat = ticks_per_beat
 
         self.relative_tick = 0
         self.final_tick = 0
 
-        if midi_track is not None and midi_track.name != "NewMidiRec":
-            self.msgs = extract_absolute_msgs_from_midi_track(midi_track, self.ticks_per_beat, self.new_ticks_per_beat)
-            self.name = midi_track.name
-        elif midi_track is not None and midi_track.name == "NewMidiRec":
-            self.msgs = extract_msgs_from_midi_track(midi_track)
+        if midi_track is not None:
+            self.events = extract_events_from_midi_track(midi_track, self.ticks_per_beat, self.new_ticks_per_beat)
             self.name = midi_track.name
-        
+        else:
+            self.events = events if events is not None else MidiEventStore()
+            self.name = name
+
         self.type = "MIDI"
         self.id_num = 0
+        self.registry = None
+        self.output = None # A ScheduledOutput, given by the MidiManager when the track is added to the registry
+        self.output_name = ""
         self.final_tick = self.calculate_final_tick()
         self.bar_length = self.final_tick / self.ticks_per_beat
 
+        self.schedule = {}
+        self.build_schedule()
+        self.revision = 0 # Changes every time the events change, so a Session knows what to save
+
         self.is_active = True
         self.is_changing_active_state = False
 
     def calculate_final_tick(self):
         final_tick = self.ticks_per_beat * 8
-        for msg in self.msgs:
+        for tick, msg in self.events.others:
             if msg.type == "end_of_track":
-                final_tick = msg.time
+                final_tick = tick
         return final_tick
 
+    # This method builds an index of the messages to send, so that each tick only touches the messages due on it. The channel messages are ordered by
+    # tick, so every tick gets [first index, last index + 1, other messages (sysex)]. Recorded messages can have fractional times: they are sent on the
+    # tick they fall in
+    def build_schedule(self):
+        schedule = {}
+        ticks = self.events.ticks
+        for index in range(len(ticks)):
+            tick = max(1, int(ticks[index]))
+            entry = schedule.get(tick)
+            if entry is None:
+                schedule[tick] = [index, index + 1, ()]
+            else:
+                entry[1] = index + 1
+        for tick, msg in self.events.others:
+            if not msg.is_meta:
+                entry = schedule.setdefault(max(1, int(tick)), [0, 0, ()])
+                entry[2] = entry[2] + (msg,)
+        self.schedule = schedule
+
+    # This method moves every message to the nearest multiple of grid ticks (counted from the start of the loop). Recordings are never quantized unless this is called
+    def quantize(self, grid):
+        ticks = self.events.ticks
+        for index in range(len(ticks)):
+            tick = round((ticks[index] - 1) / grid) * grid + 1
+            if tick > self.final_tick:
+                tick -= self.final_tick
+            ticks[index] = tick
+        self.events.sort()
+        self.build_schedule()
+        self.revision += 1
 
     def update(self, clock, output_device):
         if clock.just_ticked:
@@ -238,13 +1097,16 @@ class TrackMidi(Track):
                 self.relative_tick = 1
 
             if self.is_active:
-                for msg in self.msgs:
-                    if msg.time == self.relative_tick and not msg.is_meta:
+                entry = self.schedule.get(self.relative_tick)
+                if entry is not None:
+                    for index in range(entry[0], entry[1]):
+                        output_device.send(self.events.get_message(index))
+                    for msg in entry[2]:
                         output_device.send(msg)
 
         if self.relative_tick == self.final_tick and self.is_changing_active_state:
-            self.change_active_state()
             self.is_changing_active_state = False
+            self.change_active_state()
 
     def reset(self):
         self.relative_tick = 0
@@ -254,52 +1116,448 @@ class TrackMidi(Track):
             self.is_active = False
         elif not self.is_active:
             self.is_active = True
+        self.notify_change()
+
+
+# This class starts and stops everything at once: the midi manager (with its clock) and the audio playback. It can be used from any thread, and it also
+# follows the start/stop messages of an external midi clock. Listeners (callables without arguments) are called after every change
+class Transport:
+    def __init__(self, midi_manager, audio_recorder):
+        self.midi_manager = midi_manager
+        self.audio_recorder = audio_recorder
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.audio_recorder.tracks_lock = self.midi_manager.clock_engine.lock
+
+        if isinstance(self.midi_manager.clock_source, MidiClockSource):
+            self.midi_manager.clock_source.add_listener(self.on_external_transport)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def is_playing(self):
+        return self.midi_manager.is_active
+
+    def start(self):
+        with self.lock:
+            if not self.midi_manager.is_active:
+                with self.midi_manager.clock_engine.lock:
+                    self.midi_manager.activate()
+                    self.audio_recorder.start_playback(self.midi_manager.clock)
+        self.notify()
+
+    def stop(self):
+        with self.lock:
+            if self.midi_manager.is_active:
+                self.midi_manager.stop()
+                self.audio_recorder.stop_playback()
+        self.notify()
+
+    def toggle(self):
+        if self.midi_manager.is_active:
+            self.stop()
+        else:
+            self.start()
+
+    # A start or continue always starts from the beginning of the loops (there's no song position here)
+    def on_external_transport(self, message_type):
+        if message_type == "stop":
+            self.stop()
+        else:
+            self.stop()
+            self.start()
+
+    def notify(self):
+        for listener in self.listeners:
+            listener()
+
+
+# This class writes a type 1 midi file on its own thread, so saving never blocks the ui or the clock. It gets the tracks of the loaded file and a copy of
+# the events of the recorded tracks, and encodes them letting the clock thread take the GIL every yield_time seconds (the interpreter would only switch
+# threads every 5 ms, which is longer than a tick at high bpm). The file is written with a temporary name and renamed when it's complete, so there is
+# never a half written midi file
+class MidiExport:
+    def __init__(self, path, ticks_per_beat, midi_tracks, recorded_events, on_done=None, yield_time=0.0002):
+        self.path = path
+        self.ticks_per_beat = ticks_per_beat
+        self.midi_tracks = midi_tracks
+        self.recorded_events = recorded_events
+        self.on_done = on_done
+        self.yield_time = yield_time
+
+        self.thread = None
+        self.is_done = False
+        self.error = None
+        self.duration_ms = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="omband-midi-export", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start_time = time.perf_counter()
+        try:
+            data = self.encode()
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "wb") as midi_file:
+                midi_file.write(data)
+                midi_file.flush()
+                os.fsync(midi_file.fileno())
+            os.replace(temp_path, self.path)
+        except (OSError, ValueError) as error:
+            self.error = error
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        self.is_done = True
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def encode(self):
+        chunks = [b"MThd", struct.pack(">LHHH", 6, 1, len(self.midi_tracks) + len(self.recorded_events), self.ticks_per_beat)]
+        for midi_track in self.midi_tracks:
+            chunks.append(self.encode_track(midi_track))
+        for events in self.recorded_events:
+            msgs = itertools.chain([mido.MetaMessage("track_name", name="MidiRecord")], absolute_msgs_to_midi_track(events))
+            chunks.append(self.encode_track(msgs))
+        return b"".join(chunks)
+
+    # Same encoding as mido's, without running status
+    def encode_track(self, msgs):
+        data = bytearray()
+        last_msg = None
+        next_yield = time.perf_counter() + self.yield_time
+        for msg in msgs:
+            data.extend(mido.midifiles.meta.encode_variable_int(msg.time))
+            if msg.type == "sysex":
+                data.append(0xF0)
+                data.extend(mido.midifiles.meta.encode_variable_int(len(msg.data) + 1))
+                data.extend(msg.data)
+                data.append(0xF7)
+            else:
+                data.extend(msg.bytes())
+            last_msg = msg
+            if time.perf_counter() >= next_yield:
+                time.sleep(0)
+                next_yield = time.perf_counter() + self.yield_time
+        if last_msg is None or last_msg.type != "end_of_track":
+            data.extend(b"\x00\xff\x2f\x00")
+        return b"MTrk" + struct.pack(">L", len(data)) + bytes(data)
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+# This class saves and restores a session in a directory: manifest.json, with the state of every track in the order of the registry, a raw file of 16 bit
+# samples for every audio take (memory mapped when the session is restored, so nothing is decoded) and a file with the arrays of every midi track. Only
+# the tracks that are new or changed since the last save (or restore) are written, on a thread. The manifest is written last, and renamed into place
+class Session:
+    def __init__(self, directory):
+        self.directory = directory
+        self.saved_files = {} # track -> (file name, revision)
+        self.next_file = 1
+
+        self.thread = None
+        self.is_done = True
+        self.error = None
+        self.last_action = ""
+        self.duration_ms = 0
+        self.files_written = 0
+
+    def get_path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def exists(self):
+        return os.path.exists(self.get_path("manifest.json"))
+
+    # This method reads the state of the tracks, so it should be called holding the clock_engine lock. The files are written by another thread. It returns
+    # False if the previous save hasn't finished yet
+    def save(self, midi_manager, audio_recorder, on_done=None):
+        if not self.is_done:
+            return False
+        entries = []
+        writes = []
+        saved_files = {}
+        next_file = self.next_file
+        for track in midi_manager.track_registry.get_tracks():
+            saved = self.saved_files.get(track)
+            if saved is not None and saved[1] == track.revision:
+                file_name = saved[0]
+            else:
+                if track.type == "AUDIO":
+                    file_name = "take" + str(next_file) + (".omz" if isinstance(track.samples, CompressedSamples) else ".pcm")
+                    writes.append((file_name, track.samples))
+                else:
+                    file_name = "midi" + str(next_file) + ".bin"
+                    writes.append((file_name, track.events.copy()))
+                next_file += 1
+            saved_files[track] = (file_name, track.revision)
+
+            entry = {"id": track.id_num, "type": track.type, "name": track.name, "is_active": track.is_active,
+                     "final_tick": track.final_tick, "file": file_name}
+            if track.type == "AUDIO":
+                entry.update({"index": track.index, "start_tick": track.start_tick, "volume": track.volume_fade, "frames": len(track.samples) // audio_recorder.channels})
+                if isinstance(track.samples, CompressedSamples):
+                    entry["trim"] = track.samples.start # The compressed file is copied as it is
+            else:
+                entry.update({"is_recorded": track not in midi_manager.original_tracks, "events": len(track.events),
+                              "sysex": [[tick, list(msg.bytes())] for tick, msg in track.events.others if not msg.is_meta]})
+            entries.append(entry)
+
+        manifest = {"version": 1, "bpm": midi_manager.bpm, "ticks_per_beat": midi_manager.ticks_per_beat,
+                    "rate": audio_recorder.rate, "channels": audio_recorder.channels, "frames_per_buffer": audio_recorder.frames_per_buffer,
+                    "latency_ms": audio_recorder.latency_ms, "next_file": next_file, "tracks": entries}
+        self.is_done = False
+        self.error = None
+        self.last_action = "saved"
+        self.thread = threading.Thread(target=self.run_save, args=(manifest, writes, saved_files, on_done), name="omband-session", daemon=True)
+        self.thread.start()
+        return True
+
+    def run_save(self, manifest, writes, saved_files, on_done):
+        start_time = time.perf_counter()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            for file_name, data in writes:
+                temp_path = self.get_path(file_name + ".tmp")
+                with open(temp_path, "wb") as blob:
+                    if isinstance(data, MidiEventStore):
+                        for column, dtype in ((data.ticks, '<f8'), (data.statuses, 'u1'), (data.data1, 'u1'), (data.data2, 'u1')):
+                            blob.write(numpy.asarray(column, dtype=dtype).tobytes())
+                    elif isinstance(data, CompressedSamples):
+                        data.data.tofile(blob) # The compressed file as it is
+                    else:
+                        numpy.asarray(data, dtype='<i2').tofile(blob)
+                os.replace(temp_path, self.get_path(file_name))
+
+            temp_path = self.get_path("manifest.json.tmp")
+            with open(temp_path, "w") as manifest_file:
+                json.dump(manifest, manifest_file, indent=1)
+                manifest_file.flush()
+                os.fsync(manifest_file.fileno())
+            os.replace(temp_path, self.get_path("manifest.json"))
+
+            # The files of deleted tracks are removed once the new manifest is in place
+            in_use = set(entry["file"] for entry in manifest["tracks"])
+            for file_name in os.listdir(self.directory):
+                if re.fullmatch(r"(take\d+\.(pcm|omz)|midi\d+\.bin)", file_name) and file_name not in in_use:
+                    os.remove(self.get_path(file_name))
+
+            self.saved_files = saved_files
+            self.next_file = manifest["next_file"]
+        except (OSError, ValueError) as error:
+            self.error = error
+        self.files_written = len(writes)
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        self.is_done = True
+        if on_done is not None:
+            on_done(self)
+
+    # This method replaces every track of the midi_manager and the audio_recorder with the ones of the session. It should be called while stopped. If a
+    # file is missing or can't be read, the tracks are left as they are, error is set and it returns False
+    def load(self, midi_manager, audio_recorder):
+        start_time = time.perf_counter()
+        self.error = None
+        self.last_action = "loaded"
+        try:
+            manifest, midi_tracks, original_tracks, audio_tracks, restored, saved_files = self.read_tracks()
+            bpm, next_file = manifest["bpm"], manifest["next_file"]
+        except (OSError, ValueError, KeyError, struct.error) as error:
+            self.error = error
+            return False
+
+        registry = midi_manager.track_registry
+        for track in registry.get_tracks():
+            registry.remove(track)
+        midi_manager.tracks[:] = midi_tracks
+        midi_manager.original_tracks[:] = original_tracks
+        audio_recorder.tracks[:] = audio_tracks
+        for id_num, track in restored:
+            registry.add(track, id_num)
+
+        midi_manager.bpm = bpm
+        midi_manager.ms_per_beat = bpm_to_ms_per_beat(midi_manager.bpm)
+        midi_manager.ticks_per_beat = manifest["ticks_per_beat"]
+        audio_recorder.index = max([track.index for track in audio_tracks], default=0) + 1
+        audio_recorder.set_frames_per_buffer(manifest.get("frames_per_buffer", audio_recorder.frames_per_buffer))
+        audio_recorder.latency_ms = manifest.get("latency_ms", audio_recorder.latency_ms)
+
+        self.saved_files = saved_files
+        self.next_file = next_file
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        return True
+
+    # This method reads the manifest and the file of every track, without touching the tracks in use
+    def read_tracks(self):
+        with open(self.get_path("manifest.json")) as manifest_file:
+            manifest = json.load(manifest_file)
+        ticks_per_beat = manifest["ticks_per_beat"]
+
+        midi_tracks = []
+        original_tracks = []
+        audio_tracks = []
+        restored = []
+        saved_files = {}
+        for entry in manifest["tracks"]:
+            path = self.get_path(entry["file"])
+            if entry["type"] == "AUDIO":
+                track = TrackAudio(entry["index"], samples=map_take_samples(path, entry.get("trim", 0)))
+                track.start_tick = entry["start_tick"]
+                track.volume_fade = entry["volume"]
+                audio_tracks.append(track)
+            else:
+                track = TrackMidi(events=self.read_events(path, entry), ticks_per_beat=ticks_per_beat, name=entry["name"])
+                midi_tracks.append(track)
+                if not entry["is_recorded"]:
+                    original_tracks.append(track)
+            track.name = entry["name"]
+            track.final_tick = entry["final_tick"]
+            track.is_active = entry["is_active"]
+            saved_files[track] = (entry["file"], track.revision)
+            restored.append((entry["id"], track))
+        return manifest, midi_tracks, original_tracks, audio_tracks, restored, saved_files
+
+    def read_events(self, path, entry):
+        count = entry["events"]
+        data = numpy.fromfile(path, dtype=numpy.uint8)
+        events = MidiEventStore()
+        events.ticks.frombytes(data[:count * 8].view('<f8').astype(numpy.float64).tobytes())
+        events.statuses.frombytes(data[count * 8:count * 9].tobytes())
+        events.data1.frombytes(data[count * 9:count * 10].tobytes())
+        events.data2.frombytes(data[count * 10:count * 11].tobytes())
+        for tick, msg_bytes in entry["sysex"]:
+            events.others.append((tick, mido.Message.from_bytes(msg_bytes)))
+        events.others.append((entry["final_tick"], mido.MetaMessage("end_of_track")))
+        return events
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
 
 
 # This class saves midi files and activates the update method of the midi tracks
 class MidiManager:
-    def __init__(self):
-        self.output_device = mido.open_output(string_to_config_parser(["Ports", "output_device"]))
-
-        self.bpm = int(string_to_config_parser(["Midi", "bpm"]))
+    def __init__(self, track_registry):
+        self.track_registry = track_registry
+        self.config = get_config()
+        self.port_pool = MidiPortPool(self.config.port_check_interval)
+        self.output_device = self.port_pool.get_output(self.config.output_device)
+        self.input_device = self.port_pool.get_input(self.config.input_device)
+
+        # The midi messages of the tracks (and the midi clock) are made lookahead_ms before they're due, and sent on time by the MidiScheduler, through
+        # the output of every track ([Outputs] and [Routing] in omband.conf)
+        self.scheduler = MidiScheduler(self.config.spin_ms, self.config.sender_priority)
+        self.outputs = {}
+        for name, port_name in self.config.outputs.items():
+            output_device = self.output_device if name == "main" else self.port_pool.get_output(port_name)
+            self.outputs[name] = self.scheduler.get_output(output_device, name)
+        self.midi_output = self.outputs["main"]
+        self.scheduler.start()
+        self.port_pool.start()
+        self.track_registry.subscribe(self.on_track_changed)
+
+        self.bpm = self.config.bpm
         self.ms_per_beat = bpm_to_ms_per_beat(self.bpm)
-        self.ticks_per_beat = int(string_to_config_parser(["Midi", "ticks_per_beat"]))
+        self.ticks_per_beat = self.config.ticks_per_beat
 
-        self.midi_file = mido.MidiFile(string_to_config_parser(["Midi", "file_to_load"]))
+        self.midi_file = mido.MidiFile(self.config.file_to_load)
         self.tracks = self.load_tracks()
         self.original_tracks = []
 
         for track in self.tracks:
             self.original_tracks.append(track)
+            self.track_registry.add(track)
 
-        self.clock = Clock(self.ms_per_beat, self.ticks_per_beat)
+        # The clock is internal, or follows the midi clock received on the input. Optionally, omband sends its own midi clock to the output
+        if self.config.clock_source == "midi":
+            self.clock_source = MidiClockSource(self.input_device, self.ticks_per_beat, self.ms_per_beat, self.config.pll_bandwidth)
+        else:
+            self.clock_source = InternalClockSource()
+        self.lookahead_ticks = 0
+        self.output_clock = None
+
+        self.clock_output = None
+        if self.config.is_sending_midi_clock:
+            self.clock_output = MidiClockOutput(self.midi_output, self.ticks_per_beat)
+
+        self.clock = Clock(self.ms_per_beat, self.ticks_per_beat, self.clock_source)
         self.clock.is_active = False
-        self.midi_recorder = MidiRecorder(self.tracks)
+        self.midi_recorder = MidiRecorder(self.tracks, self.track_registry, self.input_device)
+
+        self.is_clock_threaded = self.config.is_clock_threaded
+        self.clock_engine = ClockEngine(self.config.spin_ms)
+        self.clock_engine.add_consumer(self.process_tick)
 
+        self.midi_export = None
         self.is_active = False
 
-    def save_midi_tracks_to_file(self):
+    # A midi track gets its output when it's added to the registry (loaded, recorded or restored), before the interface is told about it
+    def on_track_changed(self, track):
+        if track.type == "MIDI" and track.output is None:
+            self.route(track)
+
+    # This method looks for the id of the track in [Routing], then for its name (without the spaces around it: the metronome of metronome.midi is
+    # "Metronome "). Tracks that aren't there, or whose output doesn't exist, go to "main"
+    def route(self, track):
+        name = self.config.routes.get(str(track.id_num), self.config.routes.get(track.name.strip().lower(), "main"))
+        if name not in self.outputs:
+            name = "main"
+        track.output_name = name
+        track.output = self.outputs[name]
+
+    def get_output_devices(self):
+        return [sender.output_device for sender in self.scheduler.get_senders()]
+
+    # This one returns the names of the outputs whose port is lost
+    def get_lost_outputs(self):
+        return [sender.name for sender in self.scheduler.get_senders() if not sender.output_device.is_connected()]
+
+    # This method only copies the events of the recorded tracks (it should be called holding the clock_engine lock, as quantize changes them). The file is
+    # written by a MidiExport thread. It returns False if the previous export hasn't finished yet
+    def save_midi_tracks_to_file(self, on_done=None):
+        if self.midi_export is not None and not self.midi_export.is_done:
+            return False
+        recorded_events = []
         for track in self.tracks:
             if track not in self.original_tracks:
-                msgs = []
-                new_track = mido.MidiTrack()
-                new_track.name = "MidiRecord"
-                msgs = absolute_msgs_to_midi_track(track)
-                for msg in msgs:
-                    new_track.append(msg)
-                self.midi_file.tracks.append(new_track)
-        if not os.path.exists('midi'):
-            os.makedirs('midi')
-        self.midi_file.save("midi/" + str(time.ctime()).replace(" ", "_") + ".midi")
-
+                recorded_events.append(track.events.copy())
+        path = "midi/" + time.strftime("%Y%m%d_%H%M%S") + ".midi"
+        self.midi_export = MidiExport(path, self.midi_file.ticks_per_beat, list(self.midi_file.tracks), recorded_events, on_done)
+        self.midi_export.start()
+        return True
+
+    # This method quantizes the last midi track recorded to [Midi] quantize_grid ticks
+    def quantize_last_recording(self):
+        for track in reversed(self.tracks):
+            if track not in self.original_tracks:
+                track.quantize(self.config.quantize_grid)
+                return
 
+    # Before starting, the config file is checked for changes, so the bpm can be edited between takes
     def activate(self):
-        self.clock = Clock(self.ms_per_beat, self.ticks_per_beat)
+        if self.config.reload_if_changed():
+            self.bpm = self.config.bpm
+            self.ms_per_beat = bpm_to_ms_per_beat(self.bpm)
+        self.clock_source.start()
+        self.clock = Clock(self.ms_per_beat, self.ticks_per_beat, self.clock_source)
         self.clock.is_active = True
+        self.output_clock = Clock(self.ms_per_beat, self.ticks_per_beat, self.clock_source)
+        self.lookahead_ticks = max(0, round(self.config.lookahead_ms * 1000000 / self.clock.ns_to_next_tick))
         self.is_active = True
+        if self.clock_output is not None:
+            self.clock_output.start()
+        if self.is_clock_threaded:
+            self.clock_engine.start(self.clock)
 
     def stop(self):
-        self.output_device.reset()
+        self.clock_engine.stop()
+        self.scheduler.clear()
+        if self.clock_output is not None:
+            self.clock_output.stop()
+        for output_device in self.get_output_devices():
+            output_device.reset()
         self.clock.is_active = False
         for track in self.tracks:
             track.relative_tick = 0
@@ -314,20 +1572,550 @@ class MidiManager:
             n += 1
         return tracks
 
+    # When the clock is threaded, the ClockEngine calls process_tick by itself, so there's nothing to do here
     def update(self):
-        if self.is_active:
+        if self.is_active and not self.is_clock_threaded:
+            start = time.perf_counter_ns()
             self.clock.update()
-            self.midi_recorder.update(self.clock)
+            probes.record("Clock.update", start)
+            start = time.perf_counter_ns()
+            self.process_tick(self.clock)
+            probes.record("MidiManager.process_tick", start)
+
+    # The recorder follows the clock. The tracks and the midi clock follow output_clock, which goes lookahead_ticks ahead: every tick of the clock makes
+    # the messages of the ticks up to lookahead_ticks later, each one in a batch of the MidiScheduler with the time of its tick as target
+    def process_tick(self, clock):
+        track_count = len(self.tracks)
+        self.midi_recorder.update(clock)
+        if clock.absolute_tick == 0:
+            return
+        for track in self.tracks[track_count:]:
+            self.catch_up(track, clock)
+        output_clock = self.output_clock
+        while output_clock.absolute_tick < clock.absolute_tick + self.lookahead_ticks:
+            self.scheduler.begin_tick(clock.get_time_at(output_clock.absolute_tick + 1))
+            output_clock.tick()
+            if self.clock_output is not None:
+                self.clock_output.update(output_clock)
             for track in self.tracks:
-                track.update(self.clock, self.output_device)
+                track.update(output_clock, track.output)
+            output_clock.just_ticked = False
+            self.scheduler.end_tick()
+
+    # A track recorded while playing starts on this tick of the clock, but the ticks up to lookahead_ticks later have already been made without it.
+    # They're made now, for this track only (the first ones are going to be a little late)
+    def catch_up(self, track, clock):
+        output_clock = self.output_clock
+        output_clock.just_ticked = True
+        for tick in range(clock.absolute_tick, output_clock.absolute_tick + 1):
+            self.scheduler.begin_tick(clock.get_time_at(tick))
+            track.update(output_clock, track.output)
+            self.scheduler.end_tick()
+        output_clock.just_ticked = False
 
     def on_exit(self):
-        self.output_device.panic()
+        if self.midi_export is not None:
+            self.midi_export.join()
+        self.scheduler.stop()
+        for output_device in self.get_output_devices():
+            output_device.panic()
+        self.port_pool.close()
+
+
+# This class is a ring buffer of bytes for one producer (the audio callback) and one consumer (the WaveWriter). The buffer is allocated once.
+# The producer only moves write_position and the consumer only moves read_position (both count bytes since clear()), so no lock is needed.
+# When the buffer is full, the data is dropped and counted as an overrun, and a gap is remembered so the consumer reads silence in its place and the recording keeps its length
+class RingBuffer:
+    def __init__(self, size):
+        self.size = size
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.gaps = collections.deque() # (position, length) of the dropped data
+        self.clear()
+
+    # Only call this method when neither the producer nor the consumer is running
+    def clear(self):
+        self.write_position = 0
+        self.read_position = 0
+        self.gaps.clear()
+        self.overruns = 0
+        self.dropped_bytes = 0
+
+    def available(self):
+        return self.write_position - self.read_position
+
+    def free(self):
+        return self.size - self.available()
+
+    def write(self, data):
+        length = len(data)
+        if length > self.free():
+            self.overruns += 1
+            self.dropped_bytes += length
+            if self.gaps and self.gaps[-1][0] == self.write_position:
+                position, gap_length = self.gaps.pop()
+                self.gaps.append((position, gap_length + length))
+            else:
+                self.gaps.append((self.write_position, length))
+            return False
+
+        start = self.write_position % self.size
+        first = min(length, self.size - start)
+        self.view[start:start + first] = data[:first]
+        if first < length:
+            self.view[0:length - first] = data[first:]
+        self.write_position += length
+        return True
+
+    # This method returns up to max_length bytes, with silence in place of the dropped data
+    def read(self, max_length):
+        chunks = []
+        while max_length > 0:
+            if self.gaps and self.gaps[0][0] == self.read_position:
+                position, gap_length = self.gaps.popleft()
+                chunks.append(bytes(gap_length))
+                max_length -= gap_length
+                continue
+
+            length = min(self.available(), max_length)
+            if self.gaps:
+                length = min(length, self.gaps[0][0] - self.read_position)
+            if length <= 0:
+                break
+
+            start = self.read_position % self.size
+            first = min(length, self.size - start)
+            chunks.append(bytes(self.view[start:start + first]))
+            if first < length:
+                chunks.append(bytes(self.view[0:length - first]))
+            self.read_position += length
+            max_length -= length
+        return b"".join(chunks)
+
+
+# This class drains a RingBuffer to a wave file on its own thread, in batches of batch_size bytes, so the audio callback never touches the disk
+class WaveWriter:
+    def __init__(self, wave_file, ring_buffer, batch_size, poll_time=0.02):
+        self.wave_file = wave_file
+        self.ring_buffer = ring_buffer
+        self.batch_size = batch_size
+        self.poll_time = poll_time
+
+        self.bytes_written = 0
+        self.thread = None
+        self.is_running = False
+
+    def start(self):
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="omband-wave-writer", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while self.is_running:
+            if self.ring_buffer.available() < self.batch_size and not self.ring_buffer.gaps:
+                time.sleep(self.poll_time)
+                continue
+            self.write(self.batch_size)
+
+        # Whatever is left once the stream has stopped
+        while self.ring_buffer.available() > 0 or self.ring_buffer.gaps:
+            self.write(self.batch_size)
+        self.wave_file.close()
+
+    def write(self, max_length):
+        data = self.ring_buffer.read(max_length)
+        self.wave_file.writeframesraw(data)
+        self.bytes_written += len(data)
+
+    # This method waits until everything has been written and the wave file is closed
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+
+# This class is a ring buffer of bytes in shared memory, for one producer and one consumer in different processes (an AudioProcess and its audio
+# process). As in the RingBuffer, the producer only moves the write position and the consumer only moves the read position, so no lock is needed.
+# The block starts with a header of int64: the size, both positions, a position the consumer has to skip to (so the producer can drop what's queued),
+# and the xruns, frames and time (perf_counter_ns) of the last callback of the audio process
+class SharedRing:
+    SIZE, WRITE, READ, SKIP, XRUNS, FRAMES, CALLBACK_TIME = range(7)
+    header_size = 56
+
+    def __init__(self, size=0, name=None):
+        self.is_owner = name is None
+        if self.is_owner:
+            self.memory = shared_memory.SharedMemory(create=True, size=self.header_size + size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.name = self.memory.name
+        self.header = numpy.ndarray((7,), dtype=numpy.int64, buffer=self.memory.buf)
+        if self.is_owner:
+            self.header[:] = 0
+            self.header[self.SIZE] = size
+        self.size = int(self.header[self.SIZE])
+        self.data = self.memory.buf[self.header_size:self.header_size + self.size]
+
+    def available(self):
+        return int(self.header[self.WRITE] - max(self.header[self.READ], self.header[self.SKIP]))
+
+    def free(self):
+        return self.size - self.available()
+
+    def write(self, data):
+        length = len(data)
+        if length > self.free():
+            return False
+        position = int(self.header[self.WRITE])
+        start = position % self.size
+        first = min(length, self.size - start)
+        self.data[start:start + first] = data[:first]
+        if first < length:
+            self.data[0:length - first] = data[first:]
+        self.header[self.WRITE] = position + length # Only once the data is there
+        return True
+
+    def read(self, max_length):
+        position = int(max(self.header[self.READ], self.header[self.SKIP]))
+        length = min(int(self.header[self.WRITE]) - position, max_length)
+        start = position % self.size
+        first = min(length, self.size - start)
+        data = bytes(self.data[start:start + first])
+        if first < length:
+            data += bytes(self.data[0:length - first])
+        self.header[self.READ] = position + length
+        return data
+
+    # Only for the producer: everything written so far is dropped
+    def skip(self):
+        self.header[self.SKIP] = self.header[self.WRITE]
+
+    def close(self):
+        self.header = None
+        self.data.release()
+        self.memory.close()
+        if self.is_owner:
+            self.memory.unlink()
+
+
+# This class sends small messages (dicts, as JSON) through a SharedRing, each one after its length. It has a single sender and a single receiver
+class MessageChannel:
+    def __init__(self, size=65536, name=None):
+        self.ring = SharedRing(size, name)
+
+    def send(self, message):
+        data = json.dumps(message).encode()
+        while not self.ring.write(struct.pack("<I", len(data)) + data):
+            time.sleep(0.001) # Until the receiver makes room
+
+    # This method returns the next message, or None. A message is written at once, so if its length is there, the rest is there too
+    def receive(self):
+        if self.ring.available() < 4:
+            return None
+        length = struct.unpack("<I", self.ring.read(4))[0]
+        return json.loads(self.ring.read(length))
+
+    def close(self):
+        self.ring.close()
+
+
+# This class looks like a PyAudio to the AudioRecorder, the AudioMixer and the LatencyCalibration, but the streams are in an audio process of their
+# own ([Audio] process = yes), so the audio callbacks never wait for the GIL of this process, whatever the interface or a save are doing. Every stream
+# moves its audio through a SharedRing: the output is mixed lead_ms ahead of what's being played, and the input is read as it comes. Opening,
+# starting and stopping streams are messages on a MessageChannel, answered on another one
+class AudioProcess:
+    def __init__(self, lead_ms=100.0, timeout=10.0):
+        self.lead_ms = lead_ms
+        self.timeout = timeout
+        self.commands = MessageChannel()
+        self.replies = MessageChannel()
+        self.lock = threading.Lock() # One request at a time, so each channel has a single sender and a single receiver
+        self.next_id = 1
+
+        self.streams = []
+        self.streams_lock = threading.Lock()
+        self.closed_xruns = 0
+
+        self.process = multiprocessing.get_context("spawn").Process(target=run_audio_process, args=(self.commands.ring.name, self.replies.ring.name, os.getpid()),
+                                                                     name="omband-audio", daemon=True)
+        self.process.start()
+
+    def get_sample_size(self, format):
+        return pyaudio.get_sample_size(format)
+
+    def open(self, format, channels, rate, input=False, output=False, frames_per_buffer=1024, stream_callback=None, **kwargs):
+        return AudioProcessStream(self, format, channels, rate, input, output, frames_per_buffer, stream_callback)
+
+    # This method sends a message to the audio process and waits for the answer. Like PyAudio, it raises OSError if the stream can't be opened
+    def request(self, message):
+        with self.lock:
+            message["id"] = self.next_id
+            self.next_id += 1
+            self.commands.send(message)
+            deadline = time.perf_counter() + self.timeout
+            while True:
+                reply = self.replies.receive()
+                if reply is not None and reply["id"] == message["id"]:
+                    break
+                if reply is None:
+                    if time.perf_counter() > deadline or not self.process.is_alive():
+                        raise OSError("The audio process doesn't answer")
+                    time.sleep(0.0005)
+        if reply["error"] is not None:
+            raise OSError(reply["error"])
+        return reply
+
+    def add_stream(self, stream):
+        with self.streams_lock:
+            self.streams.append(stream)
+
+    def remove_stream(self, stream):
+        with self.streams_lock:
+            self.streams.remove(stream)
+            self.closed_xruns += stream.get_xruns()
+            stream.ring.close()
+
+    # The buffers the device played without audio from this process, and the ones it recorded without room in the ring
+    def get_xruns(self):
+        with self.streams_lock:
+            return self.closed_xruns + sum(stream.get_xruns() for stream in self.streams)
+
+    def terminate(self):
+        try:
+            self.request({"command": "quit"})
+        except OSError:
+            pass
+        self.process.join(self.timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.commands.close()
+        self.replies.close()
+
+
+# This class is a stream of an AudioProcess. Its thread calls stream_callback as PyAudio would: for an output stream, it keeps lead_ms of audio in the
+# ring, and for an input stream, it hands over every frames_per_buffer frames that arrive
+class AudioProcessStream:
+    def __init__(self, audio_process, format, channels, rate, is_input, is_output, frames_per_buffer, stream_callback):
+        self.audio_process = audio_process
+        self.rate = rate
+        self.is_input = is_input
+        self.frames_per_buffer = frames_per_buffer
+        self.stream_callback = stream_callback
+        self.frame_size = channels * audio_process.get_sample_size(format)
+        self.lead_size = max(frames_per_buffer, int(audio_process.lead_ms * rate / 1000)) * self.frame_size
+
+        self.ring = SharedRing(rate * 2 * self.frame_size if is_input else self.lead_size * 2) # Two seconds of input
+        try:
+            reply = audio_process.request({"command": "open", "ring": self.ring.name, "format": format, "channels": channels, "rate": rate, "input": is_input,
+                                           "output": is_output, "frames_per_buffer": frames_per_buffer})
+            self.output_latency = reply["output_latency"] # Of the device, without what's queued in the ring (see get_queued_ns)
+        except OSError:
+            self.ring.close()
+            raise
+        audio_process.add_stream(self)
+
+        self.thread = None
+        self.is_running = False
+
+    # The output is queued before the device starts, so it doesn't start with an xrun
+    def start_stream(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="omband-audio-stream", daemon=True)
+        self.thread.start()
+        self.audio_process.request({"command": "start", "ring": self.ring.name})
+
+    def run(self):
+        buffer_size = self.frames_per_buffer * self.frame_size
+        while self.is_running:
+            if self.is_input:
+                self.read_input(buffer_size)
+            else:
+                while self.ring.available() + buffer_size <= self.lead_size:
+                    data, flag = self.stream_callback(None, self.frames_per_buffer, None, 0)
+                    self.ring.write(data)
+            time.sleep(self.frames_per_buffer / self.rate / 2)
+        if self.is_input:
+            self.read_input(self.frame_size) # What arrived before the device stopped
+
+    def read_input(self, buffer_size):
+        while self.ring.available() >= buffer_size:
+            data = self.ring.read(self.frames_per_buffer * self.frame_size)
+            self.stream_callback(data, len(data) // self.frame_size, None, 0)
+
+    def stop_stream(self):
+        if not self.is_running:
+            return
+        self.audio_process.request({"command": "stop", "ring": self.ring.name})
+        self.is_running = False
+        self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop_stream()
+        try:
+            self.audio_process.request({"command": "close", "ring": self.ring.name})
+        finally:
+            self.audio_process.remove_stream(self)
+
+    def is_active(self):
+        return self.is_running
+
+    def get_output_latency(self):
+        return self.output_latency
+
+    # This method drops the output that's queued and not played yet (the AudioMixer calls it when the transport starts or stops)
+    def skip(self):
+        self.ring.skip()
+
+    # This one returns how long until what's written now is played: what's queued, and the wait for the callback of the device that reads the first of it
+    def get_queued_ns(self):
+        period = self.frames_per_buffer * 1000000000 // self.rate
+        next_callback = max(0, int(self.ring.header[SharedRing.CALLBACK_TIME]) + period - time.perf_counter_ns())
+        return self.ring.available() * 1000000000 // (self.frame_size * self.rate) + min(period, next_callback)
+
+    def get_xruns(self):
+        return int(self.ring.header[SharedRing.XRUNS])
+
+
+# This class is a PyAudio stream of the audio process. Its callback only copies between the device and the SharedRing, so it never waits for anything
+class DeviceStream:
+    def __init__(self, p, message):
+        self.ring = SharedRing(name=message["ring"])
+        self.is_input = message["input"]
+        self.frame_size = message["channels"] * p.get_sample_size(message["format"])
+        try:
+            self.stream = p.open(format=message["format"], channels=message["channels"], rate=message["rate"], input=message["input"], output=message["output"],
+                                 frames_per_buffer=message["frames_per_buffer"], stream_callback=self.callback, start=False)
+        except OSError:
+            self.ring.close()
+            raise
+
+    def callback(self, in_data, frame_count, time_info, status):
+        header = self.ring.header
+        header[SharedRing.FRAMES] += frame_count
+        header[SharedRing.CALLBACK_TIME] = time.perf_counter_ns()
+        if self.is_input:
+            if not self.ring.write(in_data):
+                header[SharedRing.XRUNS] += 1
+            return in_data, pyaudio.paContinue
+        length = frame_count * self.frame_size
+        data = self.ring.read(length)
+        if len(data) < length:
+            header[SharedRing.XRUNS] += 1
+            data += bytes(length - len(data))
+        return data, pyaudio.paContinue
+
+    def start(self):
+        self.stream.start_stream()
+
+    def stop(self):
+        self.stream.stop_stream()
+
+    def close(self):
+        self.stream.close()
+        self.ring.close()
+
+
+# This function is the audio process of an AudioProcess. It opens the streams it's asked for and answers every message. It quits with the "quit" message,
+# or when the process that started it is gone. Ctrl+C is for that process, which stops this one
+def run_audio_process(command_name, reply_name, parent_pid):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    commands = MessageChannel(name=command_name)
+    replies = MessageChannel(name=reply_name)
+    p = pyaudio.PyAudio()
+    streams = {}
+    is_running = True
+    while is_running and os.getppid() == parent_pid:
+        message = commands.receive()
+        if message is None:
+            time.sleep(0.001)
+            continue
+        reply = {"id": message["id"], "error": None}
+        try:
+            command = message["command"]
+            if command == "open":
+                streams[message["ring"]] = DeviceStream(p, message)
+                reply["output_latency"] = streams[message["ring"]].stream.get_output_latency()
+            elif command == "start":
+                streams[message["ring"]].start()
+            elif command == "stop":
+                streams[message["ring"]].stop()
+            elif command == "close":
+                streams.pop(message["ring"]).close()
+            elif command == "quit":
+                is_running = False
+        except (OSError, KeyError) as error:
+            reply["error"] = str(error)
+        replies.send(reply)
+    for stream in streams.values():
+        stream.close()
+    p.terminate()
+    commands.close()
+    replies.close()
+
+
+# This class runs functions, in the order they were given, on a thread of its own, which is started the first time it's needed
+class Worker:
+    def __init__(self, name):
+        self.name = name
+        self.queue = collections.deque() # (function, arguments), the one running first
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def put(self, function, *arguments):
+        with self.condition:
+            self.queue.append((function, arguments))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+                self.thread.start()
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                function, arguments = self.queue[0]
+            try:
+                function(*arguments)
+            finally:
+                with self.condition:
+                    self.queue.popleft()
+                    self.condition.notify_all()
+
+    # This method waits until every function given so far has run
+    def join(self):
+        with self.condition:
+            while self.queue:
+                self.condition.wait()
+
+
+# This class is a take of the AudioRecorder. Its input stream records until frames_to_record frames are recorded (None until the recording stops)
+class AudioTake:
+    def __init__(self, index):
+        self.index = index
+        self.stream = None
+        self.wave_writer = None
+        self.error = None
+
+        self.frames_recorded = 0
+        self.frames_to_record = None
+        self.final_tick = 0
+        self.start_tick = 0
+        self.playback_count = 0
+        self.start_tick_time = 0 # When the first tick of the take happened
+        self.first_frame_time = None # When the first frame was recorded (the stream is opened later, on the worker)
+        self.trim_frames = None # Set when the recording stops, see AudioRecorder.get_trim_frames
+
 
 # This class records the audio
 class AudioRecorder:
-    def __init__(self):
+    def __init__(self, track_registry):
         self.tracks = []
+        self.track_registry = track_registry
 
         self.relative_tick = 0
 
@@ -335,40 +2123,121 @@ class AudioRecorder:
         self.is_recording = False
         self.is_changing_active_state = False
 
-        self.frames_per_buffer = 512
+        config = get_config()
+        self.frames_per_buffer = config.frames_per_buffer
         self.rate = 44100
         self.channels = 1
         self.format = pyaudio.paInt16
 
-        self.total_frames = []
-        self.stream = None
-        self.p = pyaudio.PyAudio()
-        self.wave_file = None
+        self.p = get_portaudio()
+        self.frame_size = self.channels * self.p.get_sample_size(self.format)
+
+        # The sound of the first tick of a take is in it latency_ms after its first frame (measured by a LatencyCalibration), plus the time from the tick
+        # to that frame, so that much is trimmed from its start (see get_trim_frames). To keep the length of the loop, the input goes on as long after
+        # the last tick: the take stays in self.take until frames_to_record frames are recorded
+        self.latency_ms = config.latency_ms
+        self.take = None # The AudioTake being recorded
+        self.playback_count = 0 # Starts of the transport, so a take finished after a restart isn't placed on the ticks of the previous one
+
+        # The clock thread only changes the state of the takes. Their streams and files are opened and closed on this worker, and the new track is
+        # added holding tracks_lock (the Transport makes it the clock_engine lock)
+        self.worker = Worker("omband-takes")
+        self.tracks_lock = threading.RLock()
+        self.calibration = None
+        self.take_encoders = []
+        self.take_encoder = None # The last one
+
+        # The audio callback only copies into this ring buffer. The WaveWriter writes it to disk in batches
+        bytes_per_second = self.rate * self.channels * self.p.get_sample_size(self.format)
+        self.ring_buffer = RingBuffer(int(config.ring_buffer_seconds * bytes_per_second))
+        self.write_batch_size = int(config.write_batch_ms * bytes_per_second / 1000)
+
+        self.mixer = AudioMixer(self.p, self.tracks, self.rate, self.channels, self.frames_per_buffer)
+        self.mixer.open()
+        self.mixdown = None
 
         self.index = 1
 
-    # This method starts recording. It creates a stream of audio
-    def start_recording(self):
+    # The overruns of the ring buffer and, with an AudioProcess, the buffers its device had to play or record without room in their SharedRing
+    def get_xruns(self):
+        xruns = self.ring_buffer.overruns
+        if isinstance(self.p, AudioProcess):
+            xruns += self.p.get_xruns()
+        return xruns
+
+    def get_latency_frames(self):
+        return int(round(self.latency_ms * self.rate / 1000))
+
+    # The frames before the sound of the first tick of take: latency_ms, minus the time from the tick to the first frame. Until the first frame is
+    # recorded, it's only latency_ms
+    def get_trim_frames(self, take):
+        if take.first_frame_time is None:
+            return self.get_latency_frames()
+        return self.get_latency_frames() - int(round((take.first_frame_time - take.start_tick_time) * self.rate / 1000000000))
+
+    # This method reopens the output stream with a new buffer size (smaller buffers have less latency, but take more cpu). Only call it while stopped
+    def set_frames_per_buffer(self, frames_per_buffer):
+        if frames_per_buffer != self.frames_per_buffer:
+            self.mixer.close()
+            self.frames_per_buffer = frames_per_buffer
+            self.mixer = AudioMixer(self.p, self.tracks, self.rate, self.channels, self.frames_per_buffer)
+            self.mixer.open()
+
+    # This method starts recording on the tick of clock. The stream of audio is opened by the worker (see open_take)
+    def start_recording(self, clock):
+        if self.take is not None:
+            self.finish_recording()
         self.is_active = True
         self.is_recording = True
 
-        self.wave_file = wave.open("output" + str(self.index) + ".wav", 'wb')
-        self.wave_file.setnchannels(self.channels)
-        self.wave_file.setsampwidth(self.p.get_sample_size(self.format))
-        self.wave_file.setframerate(self.rate)
-        self.wave_file.writeframes(b''.join(self.total_frames))
+        self.take = AudioTake(self.index)
+        self.take.start_tick_time = clock.get_time_at(clock.absolute_tick)
+        self.index += 1
+        self.worker.put(self.open_take, self.take)
 
-        self.stream = self.p.open(format=self.format, channels=self.channels, rate=self.rate, input=True, frames_per_buffer=self.frames_per_buffer, stream_callback=self.get_callback())
-        self.stream.start_stream()
+    def open_take(self, take):
+        try:
+            wave_file = wave.open("output" + str(take.index) + ".wav", 'wb')
+            wave_file.setnchannels(self.channels)
+            wave_file.setsampwidth(self.p.get_sample_size(self.format))
+            wave_file.setframerate(self.rate)
 
-    def get_callback(self):
+            self.ring_buffer.clear()
+            take.wave_writer = WaveWriter(wave_file, self.ring_buffer, self.write_batch_size)
+            take.wave_writer.start()
+
+            take.stream = self.p.open(format=self.format, channels=self.channels, rate=self.rate, input=True, frames_per_buffer=self.frames_per_buffer, stream_callback=self.get_callback(take))
+            take.stream.start_stream()
+        except OSError as error:
+            take.error = error
+
+    def get_callback(self, take):
         def callback(in_data, frame_count, time_info, status):
-            self.wave_file.writeframes(in_data)
+            start = time.perf_counter_ns()
+            if take.frames_recorded < self.rate:
+                # The frames came before their callback, which can be late (more so the first one), never early. The earliest estimate of the first
+                # second is kept
+                first_frame_time = start - (take.frames_recorded + frame_count) * 1000000000 // self.rate
+                if take.first_frame_time is None or first_frame_time < take.first_frame_time:
+                    take.first_frame_time = first_frame_time
+            frames_to_record = take.frames_to_record
+            if frames_to_record is None:
+                self.ring_buffer.write(in_data)
+                take.frames_recorded += frame_count
+            elif take.frames_recorded < frames_to_record:
+                frames = min(frame_count, frames_to_record - take.frames_recorded)
+                self.ring_buffer.write(in_data[:frames * self.frame_size])
+                take.frames_recorded += frames
+            probes.record("AudioRecorder.callback", start)
             return in_data, pyaudio.paContinue
         return callback
 
     def update(self, clock):
+        self.track_registry.flush()
         self.change_state_check(clock)
+        take = self.take
+        if take is not None and take.frames_to_record is not None and (take.frames_recorded >= take.frames_to_record or take.error is not None):
+            self.finish_recording()
         if clock.just_ticked:
             for track in self.tracks:
                 track.update(clock)
@@ -376,117 +2245,792 @@ class AudioRecorder:
             if self.is_active and self.is_recording:
                 self.relative_tick += 1
 
-    # This one stops recording and creates a new trackAudio object
-    def stop_recording(self):
-        self.stream.stop_stream()
-        self.wave_file.close()
-        self.stream.close()
+    # This method starts playing every track from the beginning, in sync with clock
+    def start_playback(self, clock):
+        self.playback_count += 1
+        for track in self.tracks:
+            track.reset()
+            track.is_playing = True
+        self.mixer.start(clock)
+
+    def stop_playback(self):
+        if self.take is not None and self.take.frames_to_record is not None:
+            self.finish_recording() # With whatever was recorded
+        self.mixer.stop()
+        for track in self.tracks:
+            track.stop_playing()
+
+    # This one stops recording. The loop of the new track starts right now, but the take goes on until it has the trimmed frames more than the loop. The
+    # loop lasts as long as its ticks really took, which isn't the bpm of the config with an external clock
+    def stop_recording(self, clock):
+        take = self.take
+        loop_frames = int(round((clock.get_time_at(clock.absolute_tick) - take.start_tick_time) * self.rate / 1000000000))
+        take.final_tick = self.relative_tick
+        take.start_tick = clock.absolute_tick
+        take.playback_count = self.playback_count
+        take.trim_frames = self.get_trim_frames(take)
+        take.frames_to_record = max(0, take.trim_frames + loop_frames)
+
+        self.relative_tick = 0
+        self.is_recording = False
 
-        temp_track = TrackAudio(self.index)
+    # This method hands the take to the worker (see close_take)
+    def finish_recording(self):
+        take = self.take
+        self.take = None
+        self.worker.put(self.close_take, take)
+
+    # This method closes the take and creates a new trackAudio object, without the frames before the sound of its first tick (or with that much silence
+    # before it, if the latency is negative)
+    def close_take(self, take):
+        self.stop_take(take)
+        if take.error is not None:
+            return
+
+        wave_path = "output" + str(take.index) + ".wav"
+        samples = map_take_samples(wave_path) # The wave file keeps the take as it was recorded
+        trim_frames = take.trim_frames if take.trim_frames is not None else self.get_trim_frames(take)
+        trim = trim_frames * self.channels
+        temp_track = TrackAudio(take.index, samples=trim_samples(samples, trim))
         temp_track.name = "NewRec" + str(temp_track.index)
-        temp_track.final_tick = self.relative_tick
+        temp_track.final_tick = take.final_tick
+        temp_track.start_tick = take.start_tick
         temp_track.is_active = True
 
-        self.tracks.append(temp_track)
+        try:
+            with open("output" + str(take.index) + ".json", "w") as info_file: # See read_take_info
+                json.dump({"trim_frames": trim_frames, "final_tick": take.final_tick}, info_file)
+        except OSError:
+            pass # Without it, a mixdown from the command line trims latency_ms
+
+        with self.tracks_lock:
+            if take.playback_count != self.playback_count:
+                temp_track.reset()
+            self.tracks.append(temp_track)
+            self.track_registry.add(temp_track)
+        if get_config().is_compressing_takes:
+            self.compress_take(temp_track, samples, trim, wave_path)
+
+    def stop_take(self, take):
+        if take.stream is not None:
+            take.stream.stop_stream()
+            take.stream.close()
+        if take.wave_writer is not None:
+            take.wave_writer.stop()
+
+    # This method compresses the samples of a take, as they were recorded (like the wave file), with a TakeEncoder. When it's done, the track plays the
+    # compressed file, from trim on like it played the wave file, and the wave file is removed
+    def compress_take(self, track, samples, trim, wave_path):
+        def on_encoded(encoder):
+            if encoder.error is None:
+                with self.tracks_lock: # A Session may be reading the revision
+                    track.samples = CompressedSamples(encoder.path, trim)
+                    track.revision += 1 # So a Session saves the compressed take instead
+                try:
+                    os.remove(wave_path)
+                except OSError:
+                    pass
+        self.take_encoders = [encoder for encoder in self.take_encoders if not encoder.is_done]
+        self.take_encoder = TakeEncoder(samples, "output" + str(track.index) + ".omz", self.rate, self.channels, on_done=on_encoded)
+        self.take_encoders.append(self.take_encoder)
+        self.take_encoder.start()
+
+    # This method renders the audio tracks to mixdown/<date>.wav on a Mixdown thread ([Audio] mixdown_bars bars, or the longest loop if it's 0). It should be
+    # called holding the clock_engine lock, so no track is added or deleted while the loops are read. It returns False if the previous one hasn't finished
+    def start_mixdown(self, ms_per_beat, ticks_per_beat, on_done=None):
+        if self.mixdown is not None and not self.mixdown.is_done:
+            return False
+        self.mixdown = Mixdown(self.tracks, ms_per_beat, ticks_per_beat, self.rate, self.channels, on_done=on_done)
+        self.mixdown.start("mixdown/" + time.strftime("%Y%m%d_%H%M%S") + ".wav", get_config().mixdown_bars)
+        return True
+
+    # This method measures the latency with a LatencyCalibration, whose pings ([Audio] calibration_note) go to output_device. It should be called while
+    # stopped. If it works, the new latency is used from the next take on. It returns False if the previous calibration hasn't finished yet
+    def start_calibration(self, output_device, on_done=None):
+        if self.calibration is not None and not self.calibration.is_done:
+            return False
+        def on_calibrated(calibration):
+            if calibration.error is None:
+                self.latency_ms = calibration.latency_ms
+            if on_done is not None:
+                on_done(calibration)
+        self.calibration = LatencyCalibration(self.p, output_device, self.rate, self.channels, self.frames_per_buffer, get_config().calibration_note, on_done=on_calibrated)
+        self.calibration.start()
+        return True
+
+    def delete_last_track(self):
+        if len(self.tracks) > 0:
+            track = self.tracks.pop()
+            track.stop_playing()
+            self.track_registry.remove(track)
 
-        self.relative_tick = 0
-
-        self.index += 1
-        self.is_recording = False
+    def on_exit(self):
+        if self.mixdown is not None:
+            self.mixdown.join()
+        if self.calibration is not None:
+            self.calibration.join()
+        if self.take is not None: # Still recording, so it's lost, but its stream and its file are closed
+            self.worker.put(self.stop_take, self.take)
+            self.take = None
+        self.worker.join()
+        for encoder in self.take_encoders:
+            encoder.join()
+        self.mixer.close()
+        terminate_portaudio()
 
     def change_state_check(self, clock):
         if clock.relative_tick == 1 and clock.beat == 1 and self.is_changing_active_state:
             if not self.is_recording:
-                self.start_recording()
+                self.start_recording(clock)
             elif self.is_recording:
-                self.stop_recording()
+                self.stop_recording(clock)
             self.is_changing_active_state = False
 
 
-# This is the class TrackAudio. All audio tracks are of this kind
+# This class measures the latency of the takes: from their first tick to the moment its sound is in the recording. Like AudioRecorder.start_recording, it
+# opens an input stream, and then sends pings (a short note) to the synthesizer through output_device, every interval seconds. The latency of a ping is
+# where it starts in the recording (see find_onset) minus where it would be if there were no latency at all. It's the median of the pings that were
+# heard, and it fails if half of them weren't. It runs on its own thread
+class LatencyCalibration:
+    def __init__(self, p, output_device, rate, channels, frames_per_buffer, note=60, pings=5, interval=0.5, on_done=None):
+        self.p = p
+        self.output_device = output_device
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+        self.note = note
+        self.pings = pings
+        self.interval = interval
+        self.on_done = on_done
+
+        self.samples = None
+        self.frames_recorded = 0
+        self.first_frame_time = None # Like in a take, the latency is from the first frame on (see AudioRecorder.get_trim_frames)
+        self.measurements = [] # Latency of every ping that was heard, in ms
+        self.latency_ms = None
+
+        self.thread = None
+        self.is_done = True
+        self.error = None
+        self.duration_ms = 0
+
+    def start(self):
+        self.is_done = False
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name="omband-calibration", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start_time = time.perf_counter()
+        try:
+            self.measurements = self.measure()
+            if len(self.measurements) * 2 <= self.pings:
+                raise ValueError(str(len(self.measurements)) + " of " + str(self.pings) + " pings were heard")
+            self.latency_ms = float(numpy.median(self.measurements))
+        except (OSError, ValueError) as error:
+            self.error = error
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        self.is_done = True
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def callback(self, in_data, frame_count, time_info, status):
+        if self.frames_recorded < self.rate: # Like AudioRecorder's callback
+            first_frame_time = time.perf_counter_ns() - (self.frames_recorded + frame_count) * 1000000000 // self.rate
+            if self.first_frame_time is None or first_frame_time < self.first_frame_time:
+                self.first_frame_time = first_frame_time
+        data = numpy.frombuffer(in_data, dtype=numpy.int16)
+        start = self.frames_recorded * self.channels
+        length = min(len(data), len(self.samples) - start)
+        self.samples[start:start + length] = data[:length]
+        self.frames_recorded += length // self.channels
+        return in_data, pyaudio.paContinue
+
+    # The first interval seconds are silence, to know the level of the noise
+    def measure(self):
+        interval_ns = int(self.interval * 1000000000)
+        self.samples = numpy.zeros(int(self.rate * self.interval * (self.pings + 2)) * self.channels, dtype=numpy.int16)
+        self.frames_recorded = 0
+        self.first_frame_time = None
+        ping_times = []
+
+        start_ns = time.perf_counter_ns()
+        stream = self.p.open(format=pyaudio.paInt16, channels=self.channels, rate=self.rate, input=True, frames_per_buffer=self.frames_per_buffer, stream_callback=self.callback)
+        stream.start_stream()
+        try:
+            for index in range(self.pings):
+                remaining = start_ns + (index + 1) * interval_ns - time.perf_counter_ns()
+                if remaining > 0:
+                    time.sleep(remaining / 1000000000)
+                ping_times.append(time.perf_counter_ns())
+                self.output_device.send(mido.Message("note_on", note=self.note, velocity=127))
+                time.sleep(self.interval / 4)
+                self.output_device.send(mido.Message("note_off", note=self.note))
+            time.sleep(self.interval)
+        finally:
+            stream.stop_stream()
+            stream.close()
+        if self.first_frame_time is None:
+            raise ValueError("nothing was recorded")
+
+        levels = numpy.abs(self.samples[:self.frames_recorded * self.channels].reshape(-1, self.channels).astype(numpy.float32)).max(axis=1)
+        noise_frames = int(self.rate * self.interval)
+        noise_levels = levels[self.frames_per_buffer:noise_frames] # Without the first buffer, in case the stream starts with a click
+        noise = max(1.0, float(numpy.percentile(noise_levels, 99))) if len(noise_levels) > 0 else 1.0
+        measurements = []
+        half_interval = noise_frames // 2
+        for ping_time in ping_times:
+            expected = int((ping_time - self.first_frame_time) * self.rate / 1000000000)
+            onset = find_onset(levels, max(0, expected - half_interval), expected + half_interval, noise)
+            if onset is not None:
+                measurements.append((onset - expected) * 1000 / self.rate)
+        return measurements
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+# This function finds where a sound starts in levels (the absolute value of every frame) between the frames first and last: the first block of hop frames
+# that goes over a quarter of the way from the noise to the loudest block, and in it, the first frame that does. It returns None if there's nothing
+# clearly louder than the noise
+def find_onset(levels, first, last, noise, hop=32):
+    window = levels[first:last]
+    blocks = len(window) // hop
+    if blocks == 0:
+        return None
+    block_levels = window[:blocks * hop].reshape(blocks, hop).max(axis=1)
+    peak = float(block_levels.max())
+    if peak < noise * 4:
+        return None
+    threshold = noise + (peak - noise) / 4
+    start = int(numpy.argmax(block_levels > threshold)) * hop
+    return first + start + int(numpy.argmax(window[start:start + hop] > threshold))
+
+
+# These functions encode and decode a block of 16 bit samples (frames of channels samples) without losing anything. Every sample is predicted from the
+# previous ones of its channel (order 0: nothing, 1: the last one, 2: the line through the last two), with the order that leaves the smallest residuals.
+# The residuals are zigzagged (so small negative numbers become small positive ones), split in byte planes (the high ones are mostly zeros) and
+# compressed with zlib. The first byte of a block is its order
+def encode_samples_block(samples, channels, level=6):
+    frames = samples.reshape(-1, channels).astype(numpy.int32)
+    first_difference = numpy.diff(frames, axis=0, prepend=numpy.zeros((1, channels), dtype=numpy.int32))
+    second_difference = numpy.diff(first_difference, axis=0, prepend=numpy.zeros((1, channels), dtype=numpy.int32))
+    residuals = [frames, first_difference, second_difference]
+    order = min(range(3), key=lambda order: int(numpy.abs(residuals[order]).sum(dtype=numpy.int64)))
+    residual = residuals[order]
+    zigzag = ((residual << 1) ^ (residual >> 31)).astype(numpy.uint32)
+    planes = numpy.ascontiguousarray(zigzag).view(numpy.uint8).reshape(-1, 4).T
+    return bytes([order]) + zlib.compress(planes.tobytes(), level)
+
+def decode_samples_block(data, channels):
+    order = int(data[0])
+    planes = numpy.frombuffer(zlib.decompress(data[1:]), dtype=numpy.uint8).reshape(4, -1)
+    zigzag = numpy.ascontiguousarray(planes.T).view(numpy.uint32).reshape(-1, channels)
+    residual = (zigzag >> 1).astype(numpy.int32) ^ -(zigzag & 1).astype(numpy.int32)
+    for step in range(order):
+        residual = numpy.cumsum(residual, axis=0, dtype=numpy.int32)
+    return residual.astype(numpy.int16).ravel()
+
+
+# This class compresses a take on its own thread, block_frames frames per block (see encode_samples_block), into a file that CompressedSamples reads:
+# a header (b"OMZ1", rate, channels, samples, samples per block, blocks), the offset of every block and of the end, and the blocks. Like the MidiExport,
+# it lets the clock thread take the GIL between blocks, and the file is written with a temporary name and renamed when it's complete
+class TakeEncoder:
+    header_format = "<4sIIQII"
+
+    def __init__(self, samples, path, rate, channels, block_frames=16384, on_done=None):
+        self.samples = samples
+        self.path = path
+        self.rate = rate
+        self.channels = channels
+        self.block_frames = block_frames
+        self.on_done = on_done
+
+        self.thread = None
+        self.is_done = False
+        self.error = None
+        self.duration_ms = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="omband-take-encoder", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        start_time = time.perf_counter()
+        try:
+            self.encode()
+        except (OSError, ValueError) as error:
+            self.error = error
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        self.is_done = True
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def encode(self):
+        block_length = self.block_frames * self.channels
+        length = len(self.samples) // self.channels * self.channels
+        block_count = (length + block_length - 1) // block_length
+        header = struct.pack(self.header_format, b"OMZ1", self.rate, self.channels, length, block_length, block_count)
+        offsets = [len(header) + 8 * (block_count + 1)]
+
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "wb") as take_file:
+            take_file.write(header + bytes(8 * (block_count + 1)))
+            for start in range(0, length, block_length):
+                block = encode_samples_block(numpy.asarray(self.samples[start:min(start + block_length, length)]), self.channels)
+                take_file.write(block)
+                offsets.append(offsets[-1] + len(block))
+                time.sleep(0)
+            take_file.seek(len(header))
+            take_file.write(numpy.array(offsets, dtype='<u8').tobytes())
+        os.replace(temp_path, self.path)
+        self.input_bytes = length * 2
+        self.output_bytes = offsets[-1]
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+# This class reads a compressed take (made by a TakeEncoder) as if it were an array of samples: len() and slices (or arrays of indices) only decode the
+# blocks they need. The file keeps the take as it was recorded, and the array starts at its sample start, like the trimmed samples of a wave file (see
+# AudioRecorder.close_take). A negative start is that much silence before the take. The file is memory mapped, and the last cache_blocks decoded blocks
+# are kept, plus the first one, where every loop comes back. After every slice, the next block is decoded ahead by the BlockPrefetcher, so playing
+# never has to wait for a block to be decoded
+class CompressedSamples:
+    def __init__(self, path, start=0, cache_blocks=4):
+        self.path = path
+        self.start = start
+        self.data = numpy.memmap(path, dtype=numpy.uint8, mode='r')
+        header_size = struct.calcsize(TakeEncoder.header_format)
+        magic, self.rate, self.channels, self.length, self.block_length, self.block_count = struct.unpack(TakeEncoder.header_format, self.data[:header_size].tobytes())
+        if magic != b"OMZ1":
+            raise ValueError(path + " is not a compressed take")
+        self.offsets = self.data[header_size:header_size + 8 * (self.block_count + 1)].view('<u8')
+
+        self.cache = collections.OrderedDict() # Block number -> its samples, the last used at the end
+        self.cache_blocks = cache_blocks
+        self.first_block = max(0, start) // self.block_length if self.block_length > 0 else 0
+        self.lock = threading.Lock()
+        self.misses = 0 # Blocks that weren't decoded ahead
+
+    def __len__(self):
+        return max(0, self.length - self.start)
+
+    def get_block(self, index, is_prefetch=False):
+        with self.lock:
+            block = self.cache.get(index)
+            if block is not None:
+                self.cache.move_to_end(index)
+                return block
+        block = decode_samples_block(self.data[int(self.offsets[index]):int(self.offsets[index + 1])], self.channels)
+        block.flags.writeable = False
+        with self.lock:
+            if not is_prefetch:
+                self.misses += 1
+            self.cache[index] = block
+            if len(self.cache) > self.cache_blocks + 1:
+                for old_index in self.cache:
+                    if old_index != self.first_block:
+                        del self.cache[old_index]
+                        break
+        return block
+
+    def prefetch(self, index):
+        if index < self.block_count and index not in self.cache:
+            prefetcher.request(self, index)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[numpy.arange(start, stop, step)]
+            if stop <= start:
+                return numpy.zeros(0, dtype=numpy.int16)
+            start, stop = start + self.start, stop + self.start # In the file
+            if start < 0:
+                silence = numpy.zeros(min(0, stop) - start, dtype=numpy.int16)
+                return numpy.concatenate((silence, self.read(0, stop))) if stop > 0 else silence
+            return self.read(start, stop)
+
+        indices = numpy.asarray(key) + self.start
+        samples = numpy.zeros(indices.shape, dtype=numpy.int16)
+        block_numbers = indices // self.block_length
+        for index in numpy.unique(block_numbers[indices >= 0]):
+            is_in_block = block_numbers == index
+            samples[is_in_block] = self.get_block(int(index))[indices[is_in_block] - index * self.block_length]
+        return samples
+
+    # This method returns the samples from start to stop of the file
+    def read(self, start, stop):
+        first_block, last_block = start // self.block_length, (stop - 1) // self.block_length
+        parts = []
+        for index in range(first_block, last_block + 1):
+            block_start = index * self.block_length
+            parts.append(self.get_block(index)[max(0, start - block_start):stop - block_start])
+        self.prefetch(last_block + 1)
+        return parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+
+    def __array__(self, dtype=None, copy=None):
+        samples = self[0:len(self)]
+        return samples if dtype is None else samples.astype(dtype)
+
+
+# This class decodes blocks of CompressedSamples ahead, on its own thread, which is started the first time it's needed
+class BlockPrefetcher:
+    def __init__(self):
+        self.queue = collections.deque() # (CompressedSamples, block number)
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def request(self, samples, index):
+        with self.condition:
+            if (samples, index) not in self.queue:
+                self.queue.append((samples, index))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="omband-prefetch", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue:
+                    self.condition.wait()
+                samples, index = self.queue.popleft()
+            samples.get_block(index, is_prefetch=True)
+
+
+prefetcher = BlockPrefetcher()
+
+
+# This is the class TrackAudio. All audio tracks are of this kind. The AudioMixer plays it: the loop starts at start_tick (an absolute tick of the clock) and lasts final_tick ticks
 class TrackAudio(Track):
-    def __init__(self, index):
+    def __init__(self, index, file_path=None, samples=None):
         self.index = index
         self.id_num = 0
 
         self.type = "AUDIO"
         self.name = ""
+        self.registry = None
+        self.output_name = ""
 
         self.relative_tick = 0
         self.final_tick = 0
+        self.start_tick = 1
 
         self.volume_fade = 1.0
 
         self.is_active = True
         self.is_playing = True
         self.is_changing_active_state = False
-        self.wave_file = pygame.mixer.Sound("output" + str(self.index) + ".wav")
+        self.revision = 0 # Changes when the take is compressed
+        if samples is None:
+            if file_path is None:
+                file_path = "output" + str(self.index) + ".wav"
+            samples = map_take_samples(file_path)
+        self.samples = samples
 
     def stop_playing(self):
-        self.wave_file.stop()
+        self.is_playing = False
 
+    # relative_tick is only kept for the UI. The loop itself (and its activation/deactivation at the end of the loop) is handled by the AudioMixer, sample by sample
     def update(self, clock):
         if clock.just_ticked:
             self.relative_tick += 1
             if self.relative_tick > self.final_tick:
                 self.relative_tick = 1
 
-            if self.relative_tick == 1 and self.is_playing:
-                self.wave_file.play()
-
-        elif self.relative_tick == 1 and not self.is_playing:
-            self.stop_playing()
-
-        if self.relative_tick == self.final_tick and self.is_changing_active_state:
-            self.change_active_state()
-            self.is_changing_active_state = False
-
     def reset(self):
         self.relative_tick = 0
+        self.start_tick = 1
 
     def change_active_state(self):
         if self.is_active:
             self.is_active = False
         elif not self.is_active:
             self.is_active = True
+        self.notify_change()
+
+    # This method adds frame_count frames of this loop, starting at the frame first_frame of the transport, to output (a float32 NumPy array)
+    def mix_into(self, output, first_frame, frame_count, mixer):
+        loop_length = mixer.tick_to_frame(self.final_tick)
+        if not self.is_playing or loop_length <= 0:
+            return
+
+        channels = mixer.channels
+        total_frames = len(self.samples) // channels
+        position = first_frame - mixer.tick_to_frame(self.start_tick)
+        done = 0
+        while done < frame_count:
+            if position + done < 0:
+                done += min(-(position + done), frame_count - done)
+                continue
+
+            offset = (position + done) % loop_length
+            length = min(frame_count - done, loop_length - offset)
+            if offset == 0 and self.is_changing_active_state:
+                self.is_changing_active_state = False
+                self.is_active = not self.is_active
+                registry = self.registry
+                if registry is not None:
+                    registry.notify_later(self) # This is the audio callback, so the listeners are called by the clock thread
+
+            available = min(length, total_frames - offset)
+            if self.is_active and available > 0:
+                segment = self.samples[offset * channels:(offset + available) * channels]
+                output[done * channels:(done + available) * channels] += segment * numpy.float32(self.volume_fade)
+            done += length
+
+
+# This class plays the audio tracks. Every loop is mixed with NumPy inside the callback of a PyAudio output stream, and its position is computed from the
+# clock's ticks, so all the loops start and stop at exact sample offsets. When its drift from the clock goes over max_drift, the sample counter is
+# corrected by a few frames at a time (see follow_clock)
+class AudioMixer:
+    def __init__(self, p, tracks, rate, channels, frames_per_buffer):
+        self.p = p
+        self.tracks = tracks
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_buffer = frames_per_buffer
+
+        self.clock = None
+        self.frames_per_tick = 0.0
+        self.frame = None # The frame of the transport being mixed (frames_per_tick per tick). None until the clock's first tick
+        self.drift = 0.0
+        self.max_drift = 16
+        self.output_latency_ns = 0
+
+        self.stream = None
+        self.is_playing = False
+
+    def open(self):
+        self.stream = self.p.open(format=pyaudio.paInt16, channels=self.channels, rate=self.rate, output=True, frames_per_buffer=self.frames_per_buffer, stream_callback=self.get_callback())
+        self.output_latency_ns = int(self.stream.get_output_latency() * 1000000000)
+        self.stream.start_stream()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+    def start(self, clock):
+        self.clock = clock
+        self.frames_per_tick = self.rate * clock.seconds_to_next_tick
+        self.frame = None
+        self.drift = 0.0
+        self.is_playing = True
+        self.skip_queued()
+
+    def stop(self):
+        self.is_playing = False
+        self.skip_queued()
+
+    # The output of an AudioProcess is mixed ahead. When the transport starts or stops, what's queued is dropped, so the change is heard right away
+    def skip_queued(self):
+        if isinstance(self.stream, AudioProcessStream):
+            self.stream.skip()
+
+    # The frames mixed now are played after the ones that are queued, which are only there with an AudioProcess
+    def get_queued_ns(self):
+        if isinstance(self.stream, AudioProcessStream):
+            return self.stream.get_queued_ns()
+        return 0
+
+    def tick_to_frame(self, tick):
+        return int(round(tick * self.frames_per_tick))
 
+    def get_callback(self):
+        def callback(in_data, frame_count, time_info, status):
+            start = time.perf_counter_ns()
+            output = self.mix(frame_count).tobytes()
+            probes.record("AudioMixer.mix", start)
+            return output, pyaudio.paContinue
+        return callback
 
-# This class is the one that keeps ticking. It's the "master clock"
+    # Nothing is mixed until the clock has ticked: before that, the time of the ticks isn't known (with an external clock) and no loop has started
+    def mix(self, frame_count):
+        output = numpy.zeros(frame_count * self.channels, dtype=numpy.float32)
+        if self.is_playing and self.clock.last_tick[0] > 0:
+            self.follow_clock()
+            for track in list(self.tracks):
+                track.mix_into(output, self.frame, frame_count, self)
+            self.frame += frame_count
+        numpy.clip(output, -32768, 32767, out=output)
+        return output.astype(numpy.int16)
+
+    # This method compares the frame being mixed with the tick of the clock (from the time of its ticks, which follow an external clock too) when it's
+    # going to be heard: after what's queued and the output latency of the stream. The first time, the frame is placed there. Then the differences are
+    # drift between the audio interface and the clock. It's averaged, and when it goes over max_drift, int(drift / max_drift) frames are skipped or
+    # repeated at once (more when an external clock is further off the bpm of the config)
+    def follow_clock(self):
+        heard_time = time.perf_counter_ns() + self.get_queued_ns() + self.output_latency_ns
+        elapsed = self.clock.get_tick_at(heard_time) * self.frames_per_tick
+        if self.frame is None:
+            self.frame = int(round(elapsed))
+        difference = elapsed - self.frame
+        self.drift = self.drift * 0.99 + difference * 0.01
+        if abs(self.drift) > self.max_drift:
+            step = int(self.drift / self.max_drift)
+            self.frame += step
+            self.drift -= step
+
+
+# This class renders the audio loops offline into a 16 bit wave file, chunk_frames at a time, so the memory used doesn't depend on the length of the mixdown.
+# The loops are placed as the AudioMixer plays them from the start of the transport, with the active state and volume they had when the Mixdown was made.
+# It can render on its own thread (start) or on the calling one (render, for the command line)
+class Mixdown:
+    def __init__(self, tracks, ms_per_beat, ticks_per_beat, rate, channels, chunk_frames=16384, on_done=None):
+        self.ticks_per_beat = ticks_per_beat
+        self.rate = rate
+        self.channels = channels
+        self.frames_per_tick = rate * (ms_per_beat / ticks_per_beat) / 1000
+        self.chunk_frames = chunk_frames
+        self.on_done = on_done
+
+        self.loops = [] # (samples, frames in the take, loop length, first frame, gain)
+        for track in tracks:
+            loop_length = self.tick_to_frame(track.final_tick)
+            if track.is_active and loop_length > 0 and len(track.samples) >= channels:
+                self.loops.append((track.samples, len(track.samples) // channels, loop_length, self.tick_to_frame(track.start_tick), numpy.float32(track.volume_fade)))
+
+        self.thread = None
+        self.is_done = False
+        self.error = None
+        self.duration_ms = 0
+        self.length = 0
+        self.frames_written = 0
+
+    def tick_to_frame(self, tick):
+        return int(round(tick * self.frames_per_tick))
+
+    # With bars = 0, the mixdown lasts until the longest loop has been played once
+    def get_length(self, bars):
+        if bars > 0:
+            return self.tick_to_frame(bars * self.ticks_per_beat * 4)
+        return max([first_frame + loop_length for samples, take_frames, loop_length, first_frame, gain in self.loops], default=0)
+
+    def mix(self, first_frame, frame_count):
+        output = numpy.zeros((frame_count, self.channels), dtype=numpy.float32)
+        frames = numpy.arange(first_frame, first_frame + frame_count)
+        channel_offsets = numpy.arange(self.channels)
+        for samples, take_frames, loop_length, loop_first_frame, gain in self.loops:
+            positions = frames - loop_first_frame
+            offsets = positions % loop_length
+            is_sounding = (positions >= 0) & (offsets < take_frames)
+            indices = (offsets[is_sounding, None] * self.channels + channel_offsets).ravel() # The samples are interleaved
+            output[is_sounding] += samples[indices].reshape(-1, self.channels) * gain
+        numpy.clip(output, -32768, 32767, out=output)
+        return output.astype(numpy.int16)
+
+    # The file is written with a temporary name and renamed when it's complete. It returns the number of frames written
+    def render(self, path, bars):
+        length = self.length = self.get_length(bars)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = path + ".tmp"
+        wave_file = wave.open(temp_path, 'wb')
+        wave_file.setnchannels(self.channels)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(self.rate)
+        frame = 0
+        while frame < self.length:
+            frame_count = min(self.chunk_frames, self.length - frame)
+            wave_file.writeframesraw(self.mix(frame, frame_count).tobytes())
+            frame += frame_count
+            self.frames_written = frame
+            time.sleep(0) # Let the clock thread take the GIL between chunks
+        wave_file.close()
+        os.replace(temp_path, path)
+        return frame
+
+    def start(self, path, bars):
+        self.thread = threading.Thread(target=self.run, args=(path, bars), name="omband-mixdown", daemon=True)
+        self.thread.start()
+
+    def run(self, path, bars):
+        start_time = time.perf_counter()
+        try:
+            self.render(path, bars)
+        except (OSError, ValueError) as error:
+            self.error = error
+        self.duration_ms = round((time.perf_counter() - start_time) * 1000)
+        self.is_done = True
+        if self.on_done is not None:
+            self.on_done(self)
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+
+
+# This class is the one that keeps ticking. It's the "master clock". Times are in nanoseconds from time.perf_counter_ns(), which is monotonic
 class Clock:
-    def __init__(self, ms_per_beat, ticks_per_beat):
+    def __init__(self, ms_per_beat, ticks_per_beat, source=None):
+        if source is None:
+            source = InternalClockSource()
+        self.source = source
         self.ticks_per_beat = ticks_per_beat
         self.seconds_to_next_tick = (ms_per_beat/self.ticks_per_beat) / 1000
+        self.ns_to_next_tick = round(self.seconds_to_next_tick * 1000000000)
 
-        self.start_time = time.time()
+        self.start_time = time.perf_counter_ns()
         self.current_time = self.start_time
-        self.final_time = self.start_time + self.seconds_to_next_tick
 
         self.relative_tick = 0
         self.absolute_tick = 0
         self.final_tick = self.ticks_per_beat * 4
+        self.final_time = self.get_next_tick_time()
+        # (absolute tick, when it happened, tick period of the source at that moment). Replaced as a whole, so other threads read a consistent one
+        self.last_tick = (0, self.start_time, self.ns_to_next_tick)
 
         self.beat = 1
+        self.bar = 0
 
         self.just_ticked = False
         self.is_active = False
 
     def update(self):
         if self.is_active:
-            self.current_time = time.time()
+            self.current_time = time.perf_counter_ns()
             self.just_ticked = False
 
-            if self.current_time >= self.final_time:
-                self.tick()
+            self.final_time = self.get_next_tick_time()
+            if self.final_time is not None and self.current_time >= self.final_time:
+                self.tick(self.final_time)
+
+    # This method returns when the next tick is due, according to the clock source. It returns None if the source doesn't know yet
+    def get_next_tick_time(self):
+        return self.source.get_next_tick_time(self)
+
+    # These methods convert a time to a tick (not rounded) and back, from the last tick and the tick period of the source, so they follow an external
+    # clock too. Ticks before the first one use the nominal period from start_time
+    def get_tick_at(self, timestamp):
+        tick, tick_time, tick_period = self.last_tick
+        return tick + (timestamp - tick_time) / tick_period
 
-    def tick(self):
+    def get_time_at(self, tick):
+        last_tick, tick_time, tick_period = self.last_tick
+        return int(tick_time + (tick - last_tick) * tick_period)
+
+    # tick_time is when the tick was due. Clocks that aren't played on time (the output_clock of the MidiManager) tick without it
+    def tick(self, tick_time=None):
         self.just_ticked = True
 
         self.relative_tick += 1
         if self.relative_tick > self.final_tick:
             self.relative_tick = 1
+        if self.relative_tick == 1:
+            self.bar += 1
 
         self.absolute_tick += 1
-        self.final_time = self.start_time + (self.seconds_to_next_tick * self.absolute_tick) # self.start_time doesn't change in order to avoid time drifting over time
+        if tick_time is not None:
+            self.last_tick = (self.absolute_tick, tick_time, self.source.get_tick_period(self))
 
         if self.relative_tick % self.ticks_per_beat == 0:
             self.beat += 1
@@ -494,13 +3038,331 @@ class Clock:
                 self.beat = 1
 
     def reset(self):
-        self.start_time = time.time()
+        self.start_time = time.perf_counter_ns()
         self.current_time = self.start_time
-        self.final_time = self.start_time + self.seconds_to_next_tick
 
         self.just_ticked = False
 
         self.relative_tick = 0
         self.absolute_tick = 0
+        self.final_time = self.get_next_tick_time()
+        self.last_tick = (0, self.start_time, self.ns_to_next_tick)
+
+        self.beat = 1
+        self.bar = 0
 
         self.final_tick = self.ticks_per_beat * 4
+
+
+# This is the default clock source: the clock runs freely from its start time. self.start_time doesn't change in order to avoid time drifting over time
+class InternalClockSource:
+    def start(self):
+        pass
+
+    def get_next_tick_time(self, clock):
+        return clock.start_time + clock.ns_to_next_tick * (clock.absolute_tick + 1)
+
+    def get_tick_period(self, clock):
+        return clock.ns_to_next_tick
+
+
+# This clock source follows the midi clock (24 pulses per beat) of another device, received on a MidiInput. The pulses arrive with jitter, so a
+# delay-locked loop smooths them: it keeps an estimate of when the last pulse really happened and of the pulse period, and the ticks in between pulses
+# are spread evenly over that period. Start, continue and stop messages are passed to the listeners (callables that receive the message type)
+class MidiClockSource:
+    def __init__(self, input_device, ticks_per_beat, ms_per_beat, bandwidth=1.0):
+        self.ticks_per_pulse = ticks_per_beat / 24
+        self.nominal_period = ms_per_beat * 1000000 / 24
+        self.bandwidth = bandwidth
+        self.max_prediction = 2 # Pulses. Past that, the clock waits for the next pulse instead of guessing
+        self.listeners = []
+
+        self.state = None # (index of the last pulse, its smoothed time, pulse period). Replaced as a whole, so other threads always read a consistent state
+        self.first_pulse = 0 # The pulse where the first tick falls
+        self.input_device = input_device
+        self.input_device.add_listener(self.on_message)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def on_message(self, msg):
+        if msg.type == "clock":
+            self.on_pulse(time.perf_counter_ns())
+        elif msg.type in ("start", "continue", "stop"):
+            if msg.type != "stop":
+                self.state = None
+                self.first_pulse = 0
+            for listener in self.listeners:
+                listener(msg.type)
+
+    def on_pulse(self, timestamp):
+        state = self.state
+        if state is None:
+            self.state = (0, timestamp, self.nominal_period)
+            return
+
+        index, pulse_time, period = state
+        if index == 0:
+            self.state = (1, timestamp, timestamp - pulse_time)
+            return
+
+        error = timestamp - (pulse_time + period)
+        if abs(error) > period:
+            self.state = (index + 1, timestamp, period) # Too far from the prediction (a tempo jump or lost pulses): follow the pulse as it is
+            return
+        omega = 2 * math.pi * self.bandwidth * period / 1000000000
+        self.state = (index + 1, pulse_time + period + math.sqrt(2) * omega * error, period + omega * omega * error)
+
+    # When the transport is started from omband, the first tick falls on the next pulse. After a start message, on the first pulse
+    def start(self):
+        state = self.state
+        if state is None:
+            self.first_pulse = 0
+        else:
+            self.first_pulse = state[0] + 1
+
+    def get_next_tick_time(self, clock):
+        state = self.state
+        if state is None:
+            return None
+        index, pulse_time, period = state
+        pulses_ahead = clock.absolute_tick / self.ticks_per_pulse - (index - self.first_pulse)
+        if pulses_ahead > self.max_prediction:
+            return None
+        return int(pulse_time + pulses_ahead * period)
+
+    # The ticks are spread evenly over the smoothed pulse period
+    def get_tick_period(self, clock):
+        state = self.state
+        if state is None:
+            return clock.ns_to_next_tick
+        return state[2] / self.ticks_per_pulse
+
+    def get_bpm(self):
+        state = self.state
+        if state is None:
+            return 0
+        return 60000000000 / (state[2] * 24)
+
+
+# This class sends midi clock (24 pulses per beat) and start/stop messages to an output, so other devices can follow omband
+class MidiClockOutput:
+    def __init__(self, output_device, ticks_per_beat):
+        self.output_device = output_device
+        self.ticks_per_pulse = ticks_per_beat / 24
+        self.clock_msg = mido.Message("clock")
+
+    def start(self):
+        self.output_device.send(mido.Message("start"))
+
+    def stop(self):
+        self.output_device.send(mido.Message("stop"))
+
+    # This method sends a pulse on the ticks that start a new pulse (the first tick is the first pulse)
+    def update(self, clock):
+        if clock.just_ticked and math.floor((clock.absolute_tick - 1) / self.ticks_per_pulse) != math.floor((clock.absolute_tick - 2) / self.ticks_per_pulse):
+            self.output_device.send(self.clock_msg)
+
+
+# This class keeps a histogram of latencies (in microseconds), so percentiles can be read at any moment without storing every sample
+class LatencyHistogram:
+    def __init__(self, bin_width_us=50, bins=400):
+        self.bin_width_us = bin_width_us
+        self.counts = [0] * (bins + 1) # The last bin collects everything beyond bins * bin_width_us
+        self.count = 0
+        self.max_us = 0
+
+    def add(self, latency_ns):
+        latency_us = max(0, latency_ns // 1000)
+        index = min(latency_us // self.bin_width_us, len(self.counts) - 1)
+        self.counts[index] += 1
+        self.count += 1
+        if latency_us > self.max_us:
+            self.max_us = latency_us
+
+    # This one returns the upper edge of the bin where the given percentile falls (or the max, if it falls in the last bin)
+    def percentile(self, percent):
+        if self.count == 0:
+            return 0
+        target = self.count * percent / 100
+        accumulated = 0
+        for index, count in enumerate(self.counts):
+            accumulated += count
+            if accumulated >= target:
+                if index == len(self.counts) - 1:
+                    return self.max_us
+                return min((index + 1) * self.bin_width_us, self.max_us)
+        return self.max_us
+
+    def merge(self, other):
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.count += other.count
+        self.max_us = max(self.max_us, other.max_us)
+
+    def summary(self):
+        return "p50 " + str(self.percentile(50)) + "us p99 " + str(self.percentile(99)) + "us max " + str(self.max_us) + "us"
+
+    def reset(self):
+        self.counts = [0] * len(self.counts)
+        self.count = 0
+        self.max_us = 0
+
+
+# This class times the stages of the hot paths (the consumers of every tick, the audio callbacks, the main loop of the interface). Every stage has a
+# LatencyHistogram, and the last trace_length timings are kept for a Chrome trace (chrome://tracing or https://ui.perfetto.dev). Recording a stage costs
+# a couple of microseconds, so the probes are always on. Usage: start = time.perf_counter_ns(), the stage, probes.record("Stage", start)
+class Probes:
+    def __init__(self, trace_length=50000):
+        self.stages = {}
+        self.trace = collections.deque(maxlen=trace_length) # (name, thread id, start ns, duration ns). Appending to a deque is thread safe
+        self.window_start = time.perf_counter_ns()
+        self.last_window = {}
+        self.last_window_seconds = 0.0
+
+        self.dump_thread = None
+        self.is_dump_done = True
+        self.dump_error = None
+        self.dump_path = ""
+
+    def record(self, name, start_ns):
+        end_ns = time.perf_counter_ns()
+        histogram = self.stages.get(name)
+        if histogram is None:
+            histogram = self.stages.setdefault(name, LatencyHistogram(bin_width_us=10, bins=1000))
+        histogram.add(end_ns - start_ns)
+        self.trace.append((name, threading.get_ident(), start_ns, end_ns - start_ns))
+
+    # This method closes the current window: it keeps (count, p99, max) of every stage since the last call and starts new histograms
+    def roll(self):
+        now = time.perf_counter_ns()
+        self.last_window_seconds = (now - self.window_start) / 1000000000
+        self.window_start = now
+        window = {}
+        for name, histogram in list(self.stages.items()):
+            window[name] = (histogram.count, histogram.percentile(99), histogram.max_us)
+            histogram.reset()
+        self.last_window = window
+        return window
+
+    def get_rate(self, name):
+        if self.last_window_seconds <= 0 or name not in self.last_window:
+            return 0
+        return self.last_window[name][0] / self.last_window_seconds
+
+    # This one returns the name and the max (in us) of the stage that took the longest in the last window
+    def get_worst(self):
+        if not self.last_window:
+            return "", 0
+        name = max(self.last_window, key=lambda name: self.last_window[name][2])
+        return name, self.last_window[name][2]
+
+    # The trace is copied here and written on a thread, in pieces, so the clock thread can take the GIL in between. It returns False if busy
+    def dump_trace(self, path, on_done=None):
+        if not self.is_dump_done:
+            return False
+        self.is_dump_done = False
+        self.dump_error = None
+        self.dump_path = path
+        self.dump_thread = threading.Thread(target=self.run_dump, args=(path, list(self.trace), on_done), name="omband-trace", daemon=True)
+        self.dump_thread.start()
+        return True
+
+    def run_dump(self, path, trace, on_done):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            process_id = os.getpid()
+            thread_names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            lines = []
+            for thread_id in set(event[1] for event in trace):
+                lines.append(json.dumps({"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_id, "args": {"name": thread_names.get(thread_id, str(thread_id))}}))
+            temp_path = path + ".tmp"
+            with open(temp_path, "w") as trace_file:
+                trace_file.write('{"displayTimeUnit": "ms", "traceEvents": [')
+                separator = "\n" # Before every batch, so the last one doesn't leave a comma
+                for index, (name, thread_id, start_ns, duration_ns) in enumerate(trace):
+                    lines.append('{"name": %s, "ph": "X", "pid": %d, "tid": %d, "ts": %.3f, "dur": %.3f}' % (json.dumps(name), process_id, thread_id, start_ns / 1000, duration_ns / 1000))
+                    if index % 1000 == 999:
+                        trace_file.write(separator + ",\n".join(lines))
+                        separator = ",\n"
+                        lines = []
+                        time.sleep(0)
+                if lines:
+                    trace_file.write(separator + ",\n".join(lines))
+                trace_file.write("\n]}\n")
+            os.replace(temp_path, path)
+        except OSError as error:
+            self.dump_error = error
+        self.is_dump_done = True
+        if on_done is not None:
+            on_done(self)
+
+    def join(self):
+        if self.dump_thread is not None:
+            self.dump_thread.join()
+
+
+probes = Probes()
+
+
+# This class runs a Clock on its own thread. It sleeps until a little before each tick deadline, spins the rest of the way and then publishes the tick to its consumers (callables that receive the clock)
+class ClockEngine:
+    def __init__(self, spin_ms=0.5):
+        self.clock = None
+        self.consumers = []
+        self.spin_ns = int(spin_ms * 1000000)
+        self.source_wait_time = 0.0005
+
+        self.lateness = LatencyHistogram()
+        self.lock = threading.RLock() # Held while a tick is being published. Take it before changing the track lists from another thread
+        self.thread = None
+        self.is_running = False
+
+    def add_consumer(self, consumer):
+        self.consumers.append(consumer)
+
+    def start(self, clock):
+        self.stop()
+        self.clock = clock
+        self.lateness.reset()
+        self.is_running = True
+        self.thread = threading.Thread(target=self.run, name="omband-clock", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    # This method sleeps until spin_ns before the deadline and then spins (yielding the GIL) until the deadline
+    def wait_until(self, deadline):
+        remaining = deadline - time.perf_counter_ns()
+        if remaining > self.spin_ns:
+            time.sleep((remaining - self.spin_ns) / 1000000000)
+        while time.perf_counter_ns() < deadline:
+            time.sleep(0)
+
+    def run(self):
+        clock = self.clock
+        while self.is_running:
+            clock.final_time = clock.get_next_tick_time()
+            if clock.final_time is None:
+                time.sleep(self.source_wait_time) # The clock source is waiting for an external clock
+                continue
+            self.wait_until(clock.final_time)
+            if not self.is_running:
+                break
+
+            clock.current_time = time.perf_counter_ns()
+            self.lateness.add(clock.current_time - clock.final_time)
+            with self.lock:
+                clock.tick(clock.final_time)
+                for consumer in self.consumers:
+                    start = time.perf_counter_ns()
+                    consumer(clock)
+                    probes.record(consumer.__qualname__, start)
+                clock.just_ticked = False
+            probes.record("ClockEngine.tick", clock.current_time)
@@ -16,8 +16,11 @@ along with this program. If not, see <https://www.gnu.org/licenses/>.
 '''
 
 import curses
+import time
+import os
+import sys
+import selectors
 import cls
-import pyaudio
 
 
 class InfoWindow:
@@ -28,6 +31,14 @@ class InfoWindow:
         self.is_active = False
         self.beat = 0
 
+        self.status = ""
+        self.status_time = 0
+        self.status_interval = 0.5 # The status changes on every tick, so it's only read every status_interval seconds
+        self.drawn_state = None
+        self.session = None
+        self.is_showing_probes = False
+        self.startup_time_shown = 10 # Seconds
+
     def update(self, clock):
         if clock.is_active:
             self.is_active = True
@@ -35,7 +46,100 @@ class InfoWindow:
         if not clock or not clock.is_active:
             self.is_active = False
 
+    # The overlay shows how many times per second the main loop ran, the slowest stage and the tick lateness, over the last status_interval, and for every
+    # midi output how late it sent, how many messages per second and how many are waiting
+    def get_probes_status(self, midi_manager):
+        cls.probes.roll()
+        name, max_us = cls.probes.get_worst()
+        status = ["loop " + str(round(cls.probes.get_rate("Application.loop"))) + "/s", "worst " + name + " " + str(max_us) + "us"]
+        if midi_manager.is_clock_threaded:
+            status.append("late p99 " + str(midi_manager.clock_engine.lateness.percentile(99)) + "us")
+        for sender in midi_manager.scheduler.get_senders():
+            status.append(sender.name + " p99 " + str(sender.lateness.percentile(99)) + "us " + str(round(sender.get_rate())) + "/s backlog " + str(sender.backlog))
+        return "|".join(status)
+
+    def get_status(self, midi_manager, audio_recorder):
+        if self.is_showing_probes:
+            return self.get_probes_status(midi_manager)
+        status = []
+        if cls.startup.ready_time is not None and time.perf_counter() - cls.startup.ready_time < self.startup_time_shown:
+            status.append("ready " + str(cls.startup.get_total_ms()) + "ms")
+        session = self.session
+        if session is not None and session.last_action:
+            if not session.is_done:
+                status.append("saving session")
+            elif session.error is not None:
+                status.append("session not " + session.last_action)
+            else:
+                status.append("session " + session.last_action + " " + str(session.duration_ms) + "ms")
+        if not cls.probes.is_dump_done:
+            status.append("tracing")
+        elif cls.probes.dump_error is not None:
+            status.append("trace failed")
+        midi_export = midi_manager.midi_export
+        if midi_export is not None:
+            if not midi_export.is_done:
+                status.append("saving")
+            elif midi_export.error is not None:
+                status.append("save failed")
+            else:
+                status.append("saved " + str(midi_export.duration_ms) + "ms")
+        mixdown = audio_recorder.mixdown
+        if mixdown is not None:
+            if not mixdown.is_done:
+                status.append("mixing " + str(mixdown.frames_written * 100 // max(1, mixdown.length)) + "%")
+            elif mixdown.error is not None:
+                status.append("mixdown failed")
+            else:
+                status.append("mixdown " + str(mixdown.duration_ms) + "ms")
+        take_encoder = audio_recorder.take_encoder
+        if take_encoder is not None:
+            if not take_encoder.is_done:
+                status.append("compressing")
+            elif take_encoder.error is not None:
+                status.append("compress failed")
+            else:
+                status.append("compressed " + str(take_encoder.output_bytes * 100 // max(1, take_encoder.input_bytes)) + "% " + str(take_encoder.duration_ms) + "ms")
+        calibration = audio_recorder.calibration
+        if calibration is not None:
+            if not calibration.is_done:
+                status.append("calibrating")
+            elif calibration.error is not None:
+                status.append("calibration failed: " + str(calibration.error))
+            else:
+                status.append("latency " + str(round(calibration.latency_ms, 1)) + "ms")
+        if isinstance(midi_manager.clock_source, cls.MidiClockSource):
+            status.append("ext " + str(round(midi_manager.clock_source.get_bpm(), 1)) + " bpm")
+        if midi_manager.is_clock_threaded:
+            status.append("late " + midi_manager.clock_engine.lateness.summary())
+        status.append("send p99 " + str(midi_manager.scheduler.get_lateness().percentile(99)) + "us")
+        lost_outputs = midi_manager.get_lost_outputs()
+        if lost_outputs:
+            status.append("midi out lost " + ",".join(lost_outputs))
+        if not midi_manager.input_device.is_connected():
+            status.append("midi in lost")
+        xruns = audio_recorder.get_xruns()
+        if xruns > 0:
+            status.append("xruns " + str(xruns))
+        return "|".join(status)
+
+    def invalidate(self):
+        self.drawn_state = None
+
+    # This method only draws the window when something shown in it has changed. It returns whether it did. The terminal is updated later, with curses.doupdate()
     def draw(self, midi_manager, audio_recorder):
+        now = time.monotonic()
+        if now - self.status_time >= self.status_interval:
+            self.status = self.get_status(midi_manager, audio_recorder)
+            self.status_time = now
+
+        state = (self.is_active, self.beat, self.bpm, self.status,
+                 midi_manager.midi_recorder.is_changing_active_state, midi_manager.midi_recorder.is_recording,
+                 audio_recorder.is_changing_active_state, audio_recorder.is_recording)
+        if state == self.drawn_state:
+            return False
+        self.drawn_state = state
+
         self.display.erase()
         self.display.clrtoeol()
         self.display.border(1)
@@ -48,6 +152,9 @@ class InfoWindow:
             self.display.addstr(0, 0, "[+]" * self.beat + "[ ]" * (4 - self.beat))
         self.display.addstr(1, 11, "|" + str(self.bpm) + " bpm.|")
 
+        if self.max_x > 45:
+            self.display.addstr(1, 40, self.status[:self.max_x - 45])
+
         if midi_manager.midi_recorder.is_changing_active_state:
             self.display.addstr(1, 20, "MIDI_REC" + "|", curses.A_BLINK)
         elif midi_manager.midi_recorder.is_recording:
@@ -58,57 +165,48 @@ class InfoWindow:
         elif audio_recorder.is_recording:
             self.display.addstr(1, 29, "AUDIO_REC" + "|", curses.A_STANDOUT)
 
-        self.display.refresh()
+        self.display.noutrefresh()
+        return True
 
 
 class Slot:
-    def __init__(self, x, y, midi_manager, audio_recorder):
+    def __init__(self, x, y, track):
+        self.track = track
         self.id_num = 0
         self.name = ""
-        self.midi_manager = midi_manager
-        self.audio_recorder = audio_recorder
         self.x, self.y = x, y
         self.display = curses.newwin(3, 12, y, x)
         self.display.addstr(0, 0, str(self.name[:13]))
         self.is_active = False
         self.is_changing_active_state = False
         self.type = ""
+        self.output_name = ""
+        self.drawn_state = None
+        self.update()
 
-    def event(self, input_ch):
-        if 48 <= int(input_ch) <= 57:
-            if self.id_num == int(chr(input_ch)):
-                for track in self.midi_manager.tracks:
-                    if self.id_num == track.id_num:
-                        if not self.midi_manager.is_active:
-                            if track.is_active:
-                                track.is_active = False
-                            elif not track.is_active:
-                                track.is_active = True
-                            track.is_changing_active_state = False
-                        else:
-                            if not track.is_changing_active_state:
-                                track.is_changing_active_state = True
-                            elif track.is_changing_active_state:
-                                track.is_changing_active_state = False
-
-                for track in self.audio_recorder.tracks:
-                    if self.id_num == track.id_num:
-                        if not self.audio_recorder.is_active:
-                            if track.is_active:
-                                track.is_active = False
-                            elif not track.is_active:
-                                track.is_active = True
-                            track.is_changing_active_state = False
-                        else:
-                            if not track.is_changing_active_state:
-                                track.is_changing_active_state = True
-                            elif track.is_changing_active_state:
-                                track.is_changing_active_state = False
+    # This method copies the state of the track. The TrackGrid calls it when the registry says the track changed
+    def update(self):
+        self.id_num = self.track.id_num
+        self.name = self.track.name
+        self.type = self.track.type
+        self.output_name = self.track.output_name
+        self.is_active = self.track.is_active
+        self.is_changing_active_state = self.track.is_changing_active_state
+
+    def invalidate(self):
+        self.drawn_state = None
 
+    # Like InfoWindow.draw, this method only draws the slot when it has changed, and returns whether it did
     def draw(self):
+        state = (self.name, self.type, self.id_num, self.output_name, self.is_active, self.is_changing_active_state)
+        if state == self.drawn_state:
+            return False
+        self.drawn_state = state
+
         self.display.erase()
         self.display.border(1)
         self.display.addstr(1, 0, str(self.type))
+        self.display.addstr(2, 0, self.output_name[:8]) # The output of a midi track
         self.display.addstr(2, 9, str(self.id_num))
         if self.is_active:
             self.display.addstr(0, 0, str(self.name[:13]), curses.A_STANDOUT)
@@ -116,86 +214,79 @@ class Slot:
             self.display.addstr(0, 0, str(self.name[:13]))
         if self.is_changing_active_state:
             self.display.addstr(0, 0, "->", curses.A_BLINK)
-        self.display.refresh()
+        self.display.noutrefresh()
+        return True
 
 
+# This class shows a Slot for every track in the registry. It listens to the registry, so only the slots of the tracks that changed are updated and drawn.
+# The listener can be called from the clock or audio threads, so it only takes note of the ids; the changes are applied in update()
 class TrackGrid:
-    def __init__(self, max_x, max_y, midi_manager, audio_recorder):
+    def __init__(self, max_x, max_y, midi_manager, track_registry):
         self.midi_manager = midi_manager
-        self.audio_recorder = audio_recorder
+        self.track_registry = track_registry
 
-        self.slots = []
+        self.slots = {}
         self.max_x, self.max_y = max_x, max_y
+        self.changed_ids = set()
+        self.dirty_slots = set()
+        self.is_layout_changed = False
+        self.is_rebuilt = False
         self.create_slots()
 
+        self.track_registry.subscribe(self.on_track_changed)
+
+    def on_track_changed(self, track):
+        slot = self.slots.get(track.id_num)
+        if slot is not None and slot.track is track and self.track_registry.get(track.id_num) is track:
+            self.changed_ids.add(track.id_num)
+        else:
+            self.is_layout_changed = True
+
     def create_slots(self):
-        self.slots = []
+        self.slots = {}
         x, y = 1, 4
-        id_num = 1
-
-        for track in self.midi_manager.tracks:
-            slot = Slot(x, y, self.midi_manager, self.audio_recorder)
-            slot.name = track.name
-            slot.type = track.type
-            slot.id_num = id_num
-            track.id_num = slot.id_num
-            self.slots.append(slot)
-            if y + 4 >= self.max_y:
-                y = 1
-                x += 14
-            y += 3
-            id_num += 1
-
-        for track in self.audio_recorder.tracks:
-            slot = Slot(x, y, self.audio_recorder, self.audio_recorder)
-            slot.name = track.name
-            slot.type = track.type
-            slot.id_num = id_num
-            track.id_num = slot.id_num
-            self.slots.append(slot)
+
+        for track in self.track_registry.get_tracks():
+            self.slots[track.id_num] = Slot(x, y, track)
             if y + 4 >= self.max_y:
                 y = 1
                 x += 14
             y += 3
-            id_num += 1
+        self.dirty_slots = set(self.slots.values())
 
     def refresh(self):
-        for slot in self.slots:
-            del slot
+        self.is_layout_changed = False
+        self.changed_ids.clear()
         self.create_slots()
+        self.is_rebuilt = True
 
-    def event(self, input_ch):
-        for slot in self.slots:
-            slot.event(input_ch)
-
-    def update(self, midi_manager, audio_recorder):
-        if midi_manager.clock.just_ticked and midi_manager.clock.relative_tick == 1:
-            self.refresh()
+    def invalidate(self):
+        for slot in self.slots.values():
+            slot.invalidate()
+        self.dirty_slots = set(self.slots.values())
 
-        for slot in self.slots:
-            for track in midi_manager.tracks:
-                if slot.id_num == track.id_num:
-                    if track.is_active:
-                        slot.is_active = True
-                    else:
-                        slot.is_active = False
+    # This method returns the slots to draw, and forgets them
+    def pop_dirty_slots(self):
+        dirty_slots = self.dirty_slots
+        self.dirty_slots = set()
+        return dirty_slots
 
-                    if track.is_changing_active_state:
-                        slot.is_changing_active_state = True
-                    else:
-                        slot.is_changing_active_state = False
+    # A number key activates/deactivates the track with that id. While playing, the change waits until the end of the loop
+    def event(self, input_ch):
+        if 48 <= input_ch <= 57:
+            track = self.track_registry.get(input_ch - 48)
+            if track is not None:
+                track.toggle_active_state(self.midi_manager.is_active)
 
-            for track in audio_recorder.tracks:
-                if slot.id_num == track.id_num:
-                    if track.is_active:
-                        slot.is_active = True
-                    else:
-                        slot.is_active = False
+    def update(self):
+        if self.is_layout_changed:
+            self.refresh()
 
-                    if track.is_changing_active_state:
-                        slot.is_changing_active_state = True
-                    else:
-                        slot.is_changing_active_state = False
+        while self.changed_ids:
+            slot = self.slots.get(self.changed_ids.pop())
+            if slot is not None:
+                slot.update()
+                self.dirty_slots.add(slot)
 
 
 class Application:
@@ -208,45 +299,152 @@ class Application:
         curses.cbreak()
         curses.noecho()
 
-        self.midi_manager = cls.MidiManager()
-        self.audio_recorder = cls.AudioRecorder()
+        cls.startup.mark("curses")
+
+        self.track_registry = cls.TrackRegistry()
+        self.midi_manager = cls.MidiManager(self.track_registry)
+        cls.startup.mark("midi")
+        self.audio_recorder = cls.AudioRecorder(self.track_registry)
+        cls.startup.mark("audio")
+        self.transport = cls.Transport(self.midi_manager, self.audio_recorder)
+
+        # The last session is restored before the grid is made, so the grid starts with its tracks
+        self.session = cls.Session(cls.get_config().session_directory)
+        if cls.get_config().is_restoring_session and self.session.exists():
+            self.session.load(self.midi_manager, self.audio_recorder)
 
         self.info_window = InfoWindow(self.max_x, self.max_y)
         self.info_window.bpm = self.midi_manager.bpm
-
-        self.track_grid = TrackGrid(self.max_x, self.max_y, self.midi_manager, self.audio_recorder)
+        self.info_window.session = self.session
+
+        self.track_grid = TrackGrid(self.max_x, self.max_y, self.midi_manager, self.track_registry)
+
+        # With a threaded clock, the audio recorder gets its ticks from the ClockEngine
+        self.midi_manager.clock_engine.add_consumer(self.audio_recorder.update)
+
+        # The screen is drawn at most fps times per second, whatever the clock does
+        self.frame_time = 1 / cls.get_config().fps
+        self.last_draw_time = 0
+        self.is_invalidated = True
+        self.is_draw_pending = False
+
+        # The main loop sleeps until there's a key to read or another thread wakes it up (writing to wake_writer): the clock on every beat, and the registry when a track changes
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(sys.stdin, selectors.EVENT_READ)
+        self.wake_reader, self.wake_writer = os.pipe()
+        os.set_blocking(self.wake_reader, False)
+        os.set_blocking(self.wake_writer, False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+        self.midi_manager.clock_engine.add_consumer(self.wake_on_beat)
+        self.track_registry.subscribe(self.wake)
+        self.transport.add_listener(self.wake)
 
         self.is_running_app = True
-
+        cls.startup.mark("interface")
+
+    # This method can be called from any thread. The arguments are ignored, so it can be used as a listener
+    def wake(self, *args):
+        try:
+            os.write(self.wake_writer, b"\0")
+        except BlockingIOError:
+            pass # The pipe is full, so the main loop is going to wake up anyway
+
+    def wake_on_beat(self, clock):
+        if clock.relative_tick % clock.ticks_per_beat == 0 or clock.relative_tick == 1:
+            self.wake()
+
+    # This one returns how long the main loop can sleep. When the clock isn't threaded, the main loop is the one that makes it tick, so it can hardly sleep
+    def get_timeout(self):
+        if not self.midi_manager.is_clock_threaded:
+            return 0.001 # ATTENTION: a high sleeping time breaks this program, but it's necessary to have a sleep time if we don't want our CPU on fire.
+        if self.is_draw_pending:
+            return max(0, self.last_draw_time + self.frame_time - time.monotonic())
+        if self.midi_manager.is_active or self.audio_recorder.is_recording:
+            return self.info_window.status_interval
+        return None
+
+    def run(self):
+        self.draw()
+        cls.startup.ready()
+        while self.is_running_app:
+            for key, events in self.selector.select(self.get_timeout()):
+                if key.fileobj == self.wake_reader:
+                    try:
+                        while os.read(self.wake_reader, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+            loop_start = time.perf_counter_ns()
+            self.event()
+            cls.probes.record("Application.event", loop_start)
+            if not self.is_running_app:
+                break
+            start = time.perf_counter_ns()
+            self.update()
+            cls.probes.record("Application.update", start)
+            start = time.perf_counter_ns()
+            self.draw()
+            cls.probes.record("Application.draw", start)
+            cls.probes.record("Application.loop", loop_start)
+        self.selector.close()
+        os.close(self.wake_reader)
+        os.close(self.wake_writer)
+
+    # The MidiExport, Mixdown, Session and trace threads call this method when their file has been written, so the status is read again
+    def on_file_written(self, writer):
+        self.info_window.status_time = 0
+        self.wake()
+
+    # This method reads every key pressed since the last time
     def event(self):
         input_ch = self.screen.getch()
+        while input_ch != -1 and self.is_running_app:
+            self.key_event(input_ch)
+            input_ch = self.screen.getch()
+
+    def key_event(self, input_ch):
         if input_ch == ord("q"):
             self.on_exit()
             self.is_running_app = False
 
         if input_ch == ord("g"):
-            self.midi_manager.save_midi_tracks_to_file()
+            with self.midi_manager.clock_engine.lock:
+                self.midi_manager.save_midi_tracks_to_file(self.on_file_written)
+            self.info_window.status_time = 0
+
+        if input_ch == ord("s"):
+            with self.midi_manager.clock_engine.lock:
+                self.session.save(self.midi_manager, self.audio_recorder, self.on_file_written)
+            self.info_window.status_time = 0
+
+        if input_ch == ord("m"):
+            with self.midi_manager.clock_engine.lock:
+                self.audio_recorder.start_mixdown(self.midi_manager.ms_per_beat, self.midi_manager.ticks_per_beat, self.on_file_written)
+            self.info_window.status_time = 0
+
+        # The latency can only be measured while stopped, as the pings would be recorded over the loops
+        if input_ch == ord("l") and not self.transport.is_playing():
+            self.audio_recorder.start_calibration(self.midi_manager.output_device, self.on_file_written)
+            self.info_window.status_time = 0
+
+        if input_ch == ord("o"):
+            self.info_window.is_showing_probes = not self.info_window.is_showing_probes
+            self.info_window.status_time = 0
+
+        if input_ch == ord("t"):
+            cls.probes.dump_trace("traces/" + time.strftime("%Y%m%d_%H%M%S") + ".json", self.on_file_written)
+            self.info_window.status_time = 0
+
+        if input_ch == ord("z"):
+            with self.midi_manager.clock_engine.lock:
+                self.midi_manager.quantize_last_recording()
 
         if input_ch == ord("p"):
-            if not self.midi_manager.is_active:
-                self.midi_manager.activate()
-                for track in self.audio_recorder.tracks:
-                    track.reset()
-                    track.is_playing = True
-
-            elif self.midi_manager.is_active:
-                self.midi_manager.stop()
-                for track in self.audio_recorder.tracks:
-                    track.is_playing = False
-                    track.stop_playing()
+            self.transport.toggle()
 
         if input_ch == ord("d"):
-            if len(self.audio_recorder.tracks) > 0:
-                self.audio_recorder.tracks[-1].is_active = False
-                self.audio_recorder.tracks[-1].wave_file.stop()
-                self.audio_recorder.tracks.pop()
-                self.screen.clear()
-                self.track_grid.refresh()
+            with self.midi_manager.clock_engine.lock:
+                self.audio_recorder.delete_last_track()
 
         if input_ch == ord("r"):
             if not self.midi_manager.midi_recorder.is_changing_active_state:
@@ -263,18 +461,54 @@ class Application:
         self.track_grid.event(input_ch)
 
     def update(self):
+        self.info_window.bpm = self.midi_manager.bpm
         self.info_window.update(self.midi_manager.clock)
         self.midi_manager.update()
-        self.audio_recorder.update(self.midi_manager.clock)
-        self.track_grid.update(self.midi_manager, self.audio_recorder)
-
+        if not self.midi_manager.is_clock_threaded:
+            self.audio_recorder.update(self.midi_manager.clock)
+        start = time.perf_counter_ns()
+        self.track_grid.update()
+        cls.probes.record("TrackGrid.update", start)
+        if self.track_grid.is_rebuilt:
+            self.track_grid.is_rebuilt = False
+            self.screen.erase()
+            self.invalidate()
+
+    # This method makes the next draw paint the whole screen again
+    def invalidate(self):
+        self.is_invalidated = True
+
+    # Only the windows that changed are drawn (with noutrefresh), and the terminal is updated once, with curses.doupdate()
     def draw(self):
-        self.info_window.draw(self.midi_manager, self.audio_recorder)
-        for slot in self.track_grid.slots:
-            slot.draw()
-
-        self.screen.refresh()
-
+        now = time.monotonic()
+        if now - self.last_draw_time < self.frame_time:
+            self.is_draw_pending = True
+            return
+        self.last_draw_time = now
+        self.is_draw_pending = False
+
+        is_drawn = False
+        if self.is_invalidated:
+            self.is_invalidated = False
+            self.screen.noutrefresh()
+            self.info_window.invalidate()
+            self.track_grid.invalidate()
+            is_drawn = True
+
+        if self.info_window.draw(self.midi_manager, self.audio_recorder):
+            is_drawn = True
+        for slot in self.track_grid.pop_dirty_slots():
+            if slot.draw():
+                is_drawn = True
+
+        if is_drawn:
+            curses.doupdate()
+
+    # The transport is stopped first, so the clock (and the take being recorded) aren't running while the ports and the audio are closed
     def on_exit(self):
+        self.transport.stop()
+        self.session.join()
+        cls.probes.join()
         self.midi_manager.on_exit()
+        self.audio_recorder.on_exit()
         curses.endwin()
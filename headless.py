@@ -0,0 +1,272 @@
+''' omband, midi and audio looper
+Copyright (C) 2021,2022  Marcos Redwood (marcos.rc91 at gmail.com)
+
+This program is free software; you can redistribute it and/or
+modify it under the terms of the GNU General Public License
+as published by the Free Software Foundation; either version 2
+of the License, or (at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <https://www.gnu.org/licenses/>.
+'''
+
+import os
+import selectors
+import signal
+import socket
+import threading
+import time
+import cls
+
+
+# This class runs omband without a terminal. Instead of keys, it gets commands (one per line, see command()) from a script, from a control socket
+# (TCP, one reply line per command) and from midi control changes ([Control] section of omband.conf, e.g. cc64 = toggle)
+class HeadlessApplication:
+    def __init__(self, script_path=None, control_address=None):
+        self.track_registry = cls.TrackRegistry()
+        self.midi_manager = cls.MidiManager(self.track_registry)
+        self.audio_recorder = cls.AudioRecorder(self.track_registry)
+        self.transport = cls.Transport(self.midi_manager, self.audio_recorder)
+        self.midi_manager.clock_engine.add_consumer(self.audio_recorder.update)
+
+        self.session = cls.Session(cls.get_config().session_directory)
+        if cls.get_config().is_restoring_session and self.session.exists():
+            if not self.session.load(self.midi_manager, self.audio_recorder):
+                self.log("session not loaded: " + str(self.session.error))
+
+        self.lock = threading.Lock() # Commands can come from the script, the socket and the midi input at the same time
+        self.is_running_app = True
+
+        self.selector = selectors.DefaultSelector()
+        self.wake_reader, self.wake_writer = os.pipe()
+        os.set_blocking(self.wake_reader, False)
+        os.set_blocking(self.wake_writer, False)
+        self.selector.register(self.wake_reader, selectors.EVENT_READ)
+
+        self.server = None
+        self.clients = {}
+        if control_address is not None:
+            self.server = socket.create_server(control_address)
+            self.server.setblocking(False)
+            self.selector.register(self.server, selectors.EVENT_READ)
+
+        self.control_map = cls.get_config().control_map
+        self.control_values = {} # The last value of every control, so a knob turned past 64 runs its command once
+        if self.control_map:
+            self.midi_manager.input_device.add_listener(self.on_midi_message)
+
+        self.script_thread = None
+        if script_path is not None:
+            self.script_thread = threading.Thread(target=self.run_script, args=(script_path,), name="omband-script", daemon=True)
+        cls.startup.mark("engine")
+
+    def wake(self, *args):
+        try:
+            os.write(self.wake_writer, b"\0")
+        except BlockingIOError:
+            pass
+
+    def log(self, text):
+        print(time.strftime("%H:%M:%S") + " " + text, flush=True)
+
+    # With a threaded clock the main loop only serves the control socket. Otherwise it also polls the clock, like the interface does
+    def run(self):
+        signal.signal(signal.SIGINT, self.on_signal)
+        signal.signal(signal.SIGTERM, self.on_signal)
+        cls.startup.ready()
+        self.log(cls.startup.report())
+        if self.script_thread is not None:
+            self.script_thread.start()
+        timeout = None if self.midi_manager.is_clock_threaded else 0.001
+        while self.is_running_app:
+            for key, events in self.selector.select(timeout):
+                if key.fileobj == self.wake_reader:
+                    try:
+                        while os.read(self.wake_reader, 4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                elif key.fileobj == self.server:
+                    self.accept()
+                else:
+                    self.read_client(key.fileobj)
+            if not self.midi_manager.is_clock_threaded:
+                self.midi_manager.update()
+                self.audio_recorder.update(self.midi_manager.clock)
+        self.on_exit()
+
+    def on_signal(self, signal_number, frame):
+        self.is_running_app = False
+        self.wake()
+
+    def accept(self):
+        connection, address = self.server.accept()
+        connection.setblocking(False)
+        self.clients[connection] = b""
+        self.selector.register(connection, selectors.EVENT_READ)
+
+    def read_client(self, connection):
+        try:
+            data = connection.recv(4096)
+        except ConnectionError:
+            data = b""
+        if not data:
+            self.selector.unregister(connection)
+            del self.clients[connection]
+            connection.close()
+            return
+        buffer = self.clients[connection] + data
+        while b"\n" in buffer:
+            line, buffer = buffer.split(b"\n", 1)
+            reply = self.command(line.decode(errors="replace"))
+            try:
+                connection.sendall((reply + "\n").encode())
+            except (BlockingIOError, ConnectionError):
+                pass
+        if connection in self.clients:
+            self.clients[connection] = buffer
+
+    # A script has one command per line. Empty lines and lines starting with # are skipped. "wait" and "wait_bars" make the script wait here
+    def run_script(self, script_path):
+        with open(script_path) as script:
+            for line in script:
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                if not self.is_running_app:
+                    return
+                words = line.split()
+                if words[0] == "wait":
+                    time.sleep(float(words[1]))
+                elif words[0] == "wait_bars":
+                    self.wait_bars(int(words[1]))
+                else:
+                    self.log(line + ": " + self.command(line))
+
+    # This one waits until bars bars after the start of the current one (if the transport is restarted, they are counted again from the new start)
+    def wait_bars(self, bars):
+        clock = None
+        while self.is_running_app:
+            if self.midi_manager.clock is not clock:
+                clock = self.midi_manager.clock
+                ticks_per_bar = clock.ticks_per_beat * 4
+                target_tick = ((max(clock.absolute_tick, 1) - 1) // ticks_per_bar + bars) * ticks_per_bar + 1
+            if clock.absolute_tick >= target_tick:
+                return
+            time.sleep(0.005)
+
+    # A control change runs the command mapped to it when it goes to 64 or more from below 64 (or the first time it's 64 or more)
+    def on_midi_message(self, msg):
+        if msg.type == "control_change" and msg.control in self.control_map:
+            last_value = self.control_values.get(msg.control, 0)
+            self.control_values[msg.control] = msg.value
+            if msg.value >= 64 and last_value < 64:
+                self.log("cc" + str(msg.control) + ": " + self.command(self.control_map[msg.control]))
+
+    # This method runs a command and returns the reply. Commands: play, stop, toggle, record_midi, record_audio (arm or disarm, like "r" and "a"),
+    # mute N, unmute N, toggle N (N is the id of a track), quantize, delete, save_midi, save_session, mixdown, calibrate (only while stopped), status, quit
+    def command(self, line):
+        words = line.split()
+        if not words:
+            return "error empty command"
+        name = words[0]
+        with self.lock:
+            if name == "play":
+                self.transport.start()
+            elif name == "stop":
+                self.transport.stop()
+            elif name == "toggle" and len(words) == 1:
+                self.transport.toggle()
+            elif name == "record_midi":
+                recorder = self.midi_manager.midi_recorder
+                recorder.is_changing_active_state = not recorder.is_changing_active_state
+            elif name == "record_audio":
+                self.audio_recorder.is_changing_active_state = not self.audio_recorder.is_changing_active_state
+            elif name in ("mute", "unmute", "toggle"):
+                if len(words) != 2 or not words[1].isdigit():
+                    return "error usage: " + name + " N"
+                track = self.track_registry.get(int(words[1]))
+                if track is None:
+                    return "error no track " + words[1]
+                # A pending change (at the end of the loop) counts as done
+                is_going_to_be_active = track.is_active != track.is_changing_active_state
+                if name == "toggle" or is_going_to_be_active != (name == "unmute"):
+                    track.toggle_active_state(self.midi_manager.is_active)
+            elif name == "quantize":
+                with self.midi_manager.clock_engine.lock:
+                    self.midi_manager.quantize_last_recording()
+            elif name == "delete":
+                with self.midi_manager.clock_engine.lock:
+                    self.audio_recorder.delete_last_track()
+            elif name == "save_midi":
+                with self.midi_manager.clock_engine.lock:
+                    self.midi_manager.save_midi_tracks_to_file()
+            elif name == "save_session":
+                with self.midi_manager.clock_engine.lock:
+                    self.session.save(self.midi_manager, self.audio_recorder)
+            elif name == "mixdown":
+                with self.midi_manager.clock_engine.lock:
+                    self.audio_recorder.start_mixdown(self.midi_manager.ms_per_beat, self.midi_manager.ticks_per_beat)
+            elif name == "calibrate":
+                if self.transport.is_playing():
+                    return "error stop before calibrating"
+                if not self.audio_recorder.start_calibration(self.midi_manager.output_device, self.on_calibrated):
+                    return "error already calibrating"
+            elif name == "status":
+                return self.get_status()
+            elif name == "quit":
+                self.is_running_app = False
+                self.wake()
+            else:
+                return "error unknown command " + name
+        return "ok"
+
+    def on_calibrated(self, calibration):
+        if calibration.error is not None:
+            self.log("calibration failed: " + str(calibration.error))
+        else:
+            self.log("latency " + str(round(calibration.latency_ms, 1)) + "ms (" + ", ".join(str(round(latency, 1)) for latency in calibration.measurements) + ")")
+
+    def get_status(self):
+        clock = self.midi_manager.clock
+        status = ["playing bar " + str(clock.bar) + " beat " + str(clock.beat) if self.midi_manager.is_active else "stopped",
+                  str(self.midi_manager.bpm) + " bpm"]
+        if self.midi_manager.midi_recorder.is_recording:
+            status.append("midi rec")
+        if self.audio_recorder.is_recording:
+            status.append("audio rec")
+        tracks = []
+        for track in self.track_registry.get_tracks():
+            tracks.append(str(track.id_num) + ":" + track.type + (">" + track.output_name if track.output_name else "") + ":" + ("on" if track.is_active else "off") + ("*" if track.is_changing_active_state else ""))
+        status.append(" ".join(tracks))
+        if self.midi_manager.is_clock_threaded:
+            status.append("late " + self.midi_manager.clock_engine.lateness.summary())
+        for sender in self.midi_manager.scheduler.get_senders():
+            status.append("send " + sender.summary())
+        status.append("latency " + str(round(self.audio_recorder.latency_ms, 1)) + "ms")
+        xruns = self.audio_recorder.get_xruns()
+        if xruns > 0:
+            status.append("xruns " + str(xruns))
+        return "|".join(status)
+
+    def on_exit(self):
+        self.log("exit: " + self.get_status())
+        self.transport.stop()
+        if self.midi_manager.midi_recorder.is_recording or self.audio_recorder.is_recording:
+            self.log("exit: the take being recorded is lost")
+        self.session.join()
+        cls.probes.join()
+        self.midi_manager.on_exit()
+        self.audio_recorder.on_exit()
+        for connection in list(self.clients):
+            connection.close()
+        if self.server is not None:
+            self.server.close()
+        self.selector.close()
+        os.close(self.wake_reader)
+        os.close(self.wake_writer)
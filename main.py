@@ -15,30 +15,114 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <https://www.gnu.org/licenses/>.
 '''
 
-import gui
+import argparse
+import glob
+import re
 import time
-import pygame
 import cls
 
 
+# This function reads the command line. Every option overrides the value in the config file
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="omband, midi and audio looper")
+    parser.add_argument("--config", default="omband.conf", help="config file to read (omband.conf by default)")
+    parser.add_argument("--bpm", type=int)
+    parser.add_argument("--ticks-per-beat", type=int)
+    parser.add_argument("--input-device")
+    parser.add_argument("--output-device")
+    parser.add_argument("--file-to-load")
+    parser.add_argument("--session", help="directory of the session to restore and save")
+    parser.add_argument("--set", action="append", default=[], metavar="SECTION.OPTION=VALUE", help="override any value of the config file")
+    parser.add_argument("--mixdown", metavar="OUTPUT", help="render the audio takes to a wave file and exit, without opening the interface")
+    parser.add_argument("--bars", type=int, help="length of the mixdown ([Audio] mixdown_bars by default, 0 is the longest take)")
+    parser.add_argument("--takes", nargs="*", metavar="WAVE", help="takes to mix down (output*.wav and output*.omz by default)")
+    parser.add_argument("--startup-report", action="store_true", help="print how long every step of the start took, when omband quits")
+    parser.add_argument("--headless", action="store_true", help="run without the interface, controlled by --script, --control or the [Control] midi map")
+    parser.add_argument("--script", help="file with one command per line, for --headless")
+    parser.add_argument("--control", metavar="[HOST:]PORT", help="listen for commands on this TCP port (on localhost if there's no host), for --headless")
+    return parser.parse_args()
+
+
+def load_config(arguments):
+    config = cls.load_config(arguments.config)
+    overrides = [("Midi", "bpm", arguments.bpm),
+                 ("Midi", "ticks_per_beat", arguments.ticks_per_beat),
+                 ("Ports", "input_device", arguments.input_device),
+                 ("Ports", "output_device", arguments.output_device),
+                 ("Midi", "file_to_load", arguments.file_to_load),
+                 ("Session", "directory", arguments.session)]
+    for section, option, value in overrides:
+        if value is not None:
+            config.set_override(section, option, value)
+    for assignment in arguments.set:
+        key, value = assignment.split("=", 1)
+        section, option = key.split(".", 1)
+        config.set_override(section, option, value)
+    return config
+
+
+# This function renders the takes, all starting with the transport, at the bpm of the config. Every take loops over the ticks it lasts
+def mixdown(arguments, config):
+    takes = arguments.takes
+    if takes is None:
+        # A take being compressed has both files until it's done
+        compressed = glob.glob("output*.omz")
+        takes = [path for path in glob.glob("output*.wav") if path[:-len(".wav")] + ".omz" not in compressed] + compressed
+        takes = sorted(takes, key=lambda path: int(re.sub(r"\D", "", path) or 0))
+    ms_per_beat = cls.bpm_to_ms_per_beat(config.bpm)
+    rate, channels = 44100, 1
+    tracks = []
+    for index, path in enumerate(takes, 1):
+        # A take is trimmed as when it was recorded. Without its outputN.json, by latency_ms, and the loop is what's left of it but the latency_ms
+        # recorded after its last tick
+        info = cls.read_take_info(path)
+        if info is not None:
+            track = cls.TrackAudio(index, samples=cls.map_take_samples(path, info["trim_frames"] * channels))
+            track.final_tick = info["final_tick"]
+        else:
+            latency_frames = int(round(config.latency_ms * rate / 1000))
+            track = cls.TrackAudio(index, samples=cls.map_take_samples(path, latency_frames * channels))
+            loop_frames = len(track.samples) // channels - latency_frames
+            track.final_tick = round(loop_frames / (rate * (ms_per_beat / config.ticks_per_beat) / 1000))
+        tracks.append(track)
+    bars = arguments.bars if arguments.bars is not None else config.mixdown_bars
+    start_time = time.perf_counter()
+    frames = cls.Mixdown(tracks, ms_per_beat, config.ticks_per_beat, rate, channels).render(arguments.mixdown, bars)
+    print(arguments.mixdown + ": " + str(len(tracks)) + " takes, " + str(round(frames / rate, 2)) + " s rendered in " + str(round(time.perf_counter() - start_time, 2)) + " s")
 
 
 def main():
+    arguments = parse_arguments()
+    config = load_config(arguments)
+    cls.startup.mark("config")
+    if arguments.mixdown is not None:
+        mixdown(arguments, config)
+        return
 
+    # The backends start loading as soon as the config says how ([Audio] process), while the interface is made. A mixdown doesn't need them
+    cls.preload_backends()
+
+    # The headless mode doesn't ask anything and doesn't touch the terminal (curses isn't even imported)
+    if arguments.headless:
+        import headless
+        control_address = None
+        if arguments.control is not None:
+            host, separator, port = arguments.control.rpartition(":")
+            control_address = (host or "127.0.0.1", int(port))
+        application = headless.HeadlessApplication(arguments.script, control_address)
+        application.run()
+        return
+
+    import gui
+    cls.startup.mark("imports")
     conf_init = cls.ConfInit()
     conf_init.run()
-
-    pygame.mixer.pre_init(44100, -16, 1, 512)
-    pygame.mixer.init()
+    cls.startup.mark("prompt", is_excluded=True)
 
     application = gui.Application()
-    while application.is_running_app:
-        application.event()
-        application.update()
-        application.draw()
-        # ATTENTION: a high sleeping time breaks this program, but it's necessary to have a sleep time if we don't want our CPU on fire.
-        time.sleep(0.001)
-
+    application.run()
+    if arguments.startup_report:
+        print(cls.startup.report())
 
 
 if __name__ == "__main__":
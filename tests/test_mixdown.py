@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import unittest
+import wave
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy
+import cls
+
+
+# A loop of a bar (4 beats at 96 ticks per beat) whose take is a constant value
+def make_loop(index, value, frames=22050):
+    track = cls.TrackAudio(index, samples=numpy.full(frames, value, dtype=numpy.int16))
+    track.final_tick = 96 * 4
+    return track
+
+
+class TestMixdown(unittest.TestCase):
+    def test_mixdown_after_stop_has_the_loops(self):
+        tracks = [make_loop(1, 1000), make_loop(2, 2000)]
+        for track in tracks:
+            track.stop_playing() # As AudioRecorder.stop_playback leaves them
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "mix.wav")
+            mixdown = cls.Mixdown(tracks, 500, 96, 44100, 1)
+            frames = mixdown.render(path, 0)
+            with wave.open(path, "rb") as wave_file:
+                samples = numpy.frombuffer(wave_file.readframes(wave_file.getnframes()), dtype=numpy.int16)
+        self.assertEqual(len(mixdown.loops), 2)
+        self.assertGreaterEqual(frames, 88200) # A bar, from the start tick of the loops
+        self.assertEqual(samples.max(), 3000)
+
+    def test_inactive_loop_is_left_out(self):
+        tracks = [make_loop(1, 1000), make_loop(2, 2000)]
+        tracks[1].is_active = False
+        mixdown = cls.Mixdown(tracks, 500, 96, 44100, 1)
+        self.assertEqual(len(mixdown.loops), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cls
+
+
+class TestProbesDump(unittest.TestCase):
+    # Events are written in batches of 1000, so the lengths around a batch are the ones to check
+    def test_dump_is_valid_json(self):
+        for length in (0, 1, 999, 1000, 1001, 3000):
+            probes = cls.Probes(trace_length=length or 1)
+            probes.trace.clear()
+            for index in range(length):
+                probes.trace.append(("stage", 1, index * 1000, 500))
+            with tempfile.TemporaryDirectory() as directory:
+                path = os.path.join(directory, "trace.json")
+                probes.dump_trace(path)
+                probes.join()
+                self.assertIsNone(probes.dump_error)
+                with open(path) as trace_file:
+                    events = json.load(trace_file)["traceEvents"]
+            self.assertEqual(len([event for event in events if event["ph"] == "X"]), length)
+
+
+if __name__ == "__main__":
+    unittest.main()
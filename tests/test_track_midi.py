@@ -0,0 +1,61 @@
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import mido
+import cls
+
+
+class NullOutput:
+    def send(self, msg):
+        pass
+
+
+class Ticker:
+    def __init__(self):
+        self.just_ticked = True
+
+
+# A bar of 4 beats at 96 ticks per beat. message_count notes are on the first tick, so the other ticks have nothing to send
+def make_track(message_count, ticks_per_beat=96):
+    events = cls.MidiEventStore()
+    for index in range(message_count):
+        events.append(mido.Message("note_on", note=index % 128, velocity=100), 1)
+    events.append(mido.MetaMessage("end_of_track"), ticks_per_beat * 4)
+    return cls.TrackMidi(events=events, ticks_per_beat=ticks_per_beat)
+
+
+# This one returns the least time (in ns) that a tick without messages took, over rounds bars
+def get_tick_cost(track, rounds=20):
+    clock = Ticker()
+    output = NullOutput()
+    best = None
+    for round_number in range(rounds):
+        track.reset()
+        track.update(clock, output) # The first tick, with every message
+        start = time.perf_counter_ns()
+        for tick in range(2, track.final_tick + 1):
+            track.update(clock, output)
+        cost = (time.perf_counter_ns() - start) / (track.final_tick - 1)
+        best = cost if best is None else min(best, cost)
+    return best
+
+
+class TestTrackMidiSchedule(unittest.TestCase):
+    def test_schedule_has_every_message(self):
+        track = make_track(1000)
+        first, last, others = track.schedule[1]
+        self.assertEqual(last - first, 1000)
+        self.assertEqual(len(track.schedule), 1)
+
+    def test_tick_cost_is_flat(self):
+        small = get_tick_cost(make_track(1000))
+        large = get_tick_cost(make_track(100000))
+        self.assertLess(large, small * 3 + 1000)
+
+
+if __name__ == "__main__":
+    unittest.main()